@@ -74,6 +74,10 @@ import os
 import struct
 import operator
 import collections
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 byteorder = sys.byteorder
 
@@ -675,6 +679,39 @@ OCT_TO_BITS = ['{0:03b}'.format(i) for i in xrange(8)]
 # A dictionary of number of 1 bits contained in binary representation of any byte
 BIT_COUNT = dict(zip(xrange(256), [bin(i).count('1') for i in xrange(256)]))
 
+# The same as a translation table, to count the 1 bits of many bytes at once
+BIT_COUNT_TABLE = bytes(bytearray(BIT_COUNT[i] for i in xrange(256)))
+
+# With NumPy, bytes are counted two at a time from a table of 16-bit values,
+# once there are enough of them to be worth it
+NUMPY_COUNT_BYTES = 1024
+if numpy is not None:
+    BIT_COUNT16 = numpy.add.outer(*[numpy.frombuffer(BIT_COUNT_TABLE, numpy.uint8)] * 2).ravel()
+    # Calling the ufuncs directly saves dispatching through the operators
+    LOGICAL_UFUNCS = {operator.and_: numpy.bitwise_and, operator.or_: numpy.bitwise_or,
+                      operator.xor: numpy.bitwise_xor}
+
+def countones(data):
+    """Return the number of 1 bits in a bytearray."""
+    if numpy is not None and len(data) >= NUMPY_COUNT_BYTES:
+        words = numpy.frombuffer(data, numpy.uint16, len(data) // 2)
+        count = int(BIT_COUNT16[words].sum(dtype=numpy.int64))
+        return count + BIT_COUNT[data[-1]] if len(data) % 2 else count
+    return sum(data.translate(BIT_COUNT_TABLE))
+
+def logicalbytes(a, b, f):
+    """Return a bytearray of f applied to two equal length bytearrays.
+
+    f is operator.and_, operator.or_ or operator.xor, applied to the whole
+    buffers at once rather than byte by byte.
+
+    """
+    if numpy is not None:
+        f = LOGICAL_UFUNCS[f]
+        return bytearray(f(numpy.frombuffer(a, numpy.uint8), numpy.frombuffer(b, numpy.uint8)).tostring())
+    x = f(int(binascii.hexlify(a), 16), int(binascii.hexlify(b), 16))
+    return bytearray(binascii.unhexlify('%0*x' % (2 * len(a), x)))
+
 
 class Bits(object):
     """A container holding an immutable sequence of bits.
@@ -1073,10 +1110,14 @@ class Bits(object):
         Raises ValueError if the two bitstrings have differing lengths.
 
         """
-        bs = Bits(bs)
-        if self.len != bs.len:
+        if not isinstance(bs, Bits):
+            bs = Bits(bs)
+        a, b = self._datastore, bs._datastore
+        if a.bitlength != b.bitlength:
             raise ValueError("Bitstrings must have the same length "
                              "for & operator.")
+        if a.bitlength and not (a.offset % 8 or b.offset % 8):
+            return self._logical(bs, operator.and_)
         s = self._copy()
         s._iand(bs)
         return s
@@ -1099,10 +1140,14 @@ class Bits(object):
         Raises ValueError if the two bitstrings have differing lengths.
 
         """
-        bs = Bits(bs)
-        if self.len != bs.len:
+        if not isinstance(bs, Bits):
+            bs = Bits(bs)
+        a, b = self._datastore, bs._datastore
+        if a.bitlength != b.bitlength:
             raise ValueError("Bitstrings must have the same length "
                              "for | operator.")
+        if a.bitlength and not (a.offset % 8 or b.offset % 8):
+            return self._logical(bs, operator.or_)
         s = self._copy()
         s._ior(bs)
         return s
@@ -1125,10 +1170,14 @@ class Bits(object):
         Raises ValueError if the two bitstrings have differing lengths.
 
         """
-        bs = Bits(bs)
-        if self.len != bs.len:
+        if not isinstance(bs, Bits):
+            bs = Bits(bs)
+        a, b = self._datastore, bs._datastore
+        if a.bitlength != b.bitlength:
             raise ValueError("Bitstrings must have the same length "
                              "for ^ operator.")
+        if a.bitlength and not (a.offset % 8 or b.offset % 8):
+            return self._logical(bs, operator.xor)
         s = self._copy()
         s._ixor(bs)
         return s
@@ -2192,6 +2241,28 @@ class Bits(object):
         self._append(self[0:(n - m) * old_len])
         return self
 
+    def _logical(self, bs, f):
+        """Return new bitstring of f applied to two bitstrings of the same
+        length which both start on a byte boundary."""
+        a, b = self._datastore, bs._datastore
+        bytelength = (a.bitlength + 7) // 8
+        starta, startb = a.offset // 8, b.offset // 8
+        if numpy is not None and type(a._rawarray) is bytearray and type(b._rawarray) is bytearray:
+            # Read the stores in place rather than slicing copies of them
+            data = bytearray(LOGICAL_UFUNCS[f](
+                numpy.frombuffer(a._rawarray, numpy.uint8, bytelength, starta),
+                numpy.frombuffer(b._rawarray, numpy.uint8, bytelength, startb)).tostring())
+        else:
+            data = logicalbytes(a.getbyteslice(starta, starta + bytelength),
+                                b.getbyteslice(startb, startb + bytelength), f)
+        # Skip the initialisers, which would copy the new data again. Only
+        # the streams and other subclasses have anything more to set up.
+        s = object.__new__(self.__class__)
+        s._datastore = ByteStore(data, a.bitlength, 0)
+        if s.__class__ is not Bits and s.__class__ is not BitArray:
+            s.__init__()
+        return s
+
     def _inplace_logical_helper(self, bs, f):
         """Helper function containing most of the __ior__, __iand__, __ixor__ code."""
         # Give the two bitstrings the same offset (modulo 8)
@@ -2706,7 +2777,7 @@ class Bits(object):
             return 0
         # count the number of 1s (from which it's easy to work out the 0s).
         # Don't count the final byte yet.
-        count = sum(BIT_COUNT[self._datastore.getbyte(i)] for i in xrange(self._datastore.bytelength - 1))
+        count = countones(self._datastore.getbyteslice(0, self._datastore.bytelength - 1))
         # adjust for bits at start that aren't part of the bitstring
         if self._offset:
             count -= BIT_COUNT[self._datastore.getbyte(0) >> (8 - self._offset)]
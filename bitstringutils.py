@@ -29,13 +29,269 @@ __version__ = "1.2"
 
 __author__ = "Ryan Helinski and Mitch Martin"
 
+import binascii
 import bitstring
+import numpy
+
+# Number of set bits in each 16-bit value, for table-driven popcounts of packed words
+POPCOUNT16 = numpy.array([bin(i).count('1') for i in range(2 ** 16)], numpy.uint8)
+
+# Bytes below which bits are counted faster in one big integer than by NumPy
+NUMPY_MIN_BYTES = 128
+
+# Words of the XOR of signatures counted at once by hd_matrix, to fit in cache
+HD_BLOCK_WORDS = 2 ** 15
+# Rows of signatures unpacked at once by hd_matrix to be multiplied, and 
+# their size in bits, which bound its temporaries
+HD_BLOCK_ROWS = 2 ** 10
+HD_BLOCK_BITS = 2 ** 20
+# Rows below which hd_matrix counts the bits of XORs rather than multiplying
+HD_MIN_GEMM_ROWS = 16
 
 def hd (a, b):
-    return (a ^ b).count(1)
+    """Hamming distance between a and b. Bit strings of whole bytes are
+    compared over their raw bytes, without building the XOR as a bit string."""
+    x, y = raw_bytes(a), raw_bytes(b)
+    if x is None or y is None or len(x) != len(y):
+        return (a ^ b).count(1)
+    if len(x) < NUMPY_MIN_BYTES:
+        return bin(bytes_to_int(x) ^ bytes_to_int(y)).count('1')
+    return popcount_bytes(numpy.frombuffer(x, numpy.uint8) ^ numpy.frombuffer(y, numpy.uint8))
 
 def hw (a):
-    return a.count(1)
+    x = raw_bytes(a)
+    if x is None:
+        return a.count(1)
+    if len(x) < NUMPY_MIN_BYTES:
+        return bin(bytes_to_int(x)).count('1')
+    return popcount_bytes(numpy.frombuffer(x, numpy.uint8))
+
+def raw_bytes(bits):
+    """The bytes of a bit string which starts on a byte boundary and is a 
+    whole number of bytes long, read straight from its store, else None"""
+    store = getattr(bits, '_datastore', None)
+    if store is None or store.offset or store.bitlength % 8:
+        return None
+    return store.getbyteslice(0, store.bytelength)
+
+def bytes_to_int(data):
+    return int(binascii.hexlify(data) or '0', 16)
+
+def popcount_bytes(data):
+    """Count the set bits of an array of bytes"""
+    if len(data) % 2:
+        # the first 256 entries of the table count the bits of a byte
+        return int(POPCOUNT16[data].sum())
+    return int(POPCOUNT16[data.view(numpy.uint16)].sum())
 
 def as_ints(bits):
-    return bits.unpack(fmt='bin:%d' % len(bits))[0]
+    return unpack_bits(bits)
+
+def bytes_view(bits):
+    """The bytes of a bit string as a read-only NumPy array. If the bit 
+    string starts on a byte boundary, any bits in the last byte past its 
+    end are not masked. For a bit string made by array_to_bits, this is a 
+    view of its array rather than a copy. Other bit strings are copied: a 
+    bytearray store may be shared with a BitArray, and when that grows the 
+    memory a view would read is freed."""
+    store = bits._datastore
+    if store.offset % 8:
+        data = numpy.frombuffer(bits.tobytes(), numpy.uint8)
+    elif isinstance(store.rawbytes, NumpyByteArray):
+        data = store.rawbytes.array[store.byteoffset:store.byteoffset+store.bytelength]
+    else:
+        # a bytearray, or mapped from a file
+        data = numpy.frombuffer(store.getbyteslice(store.byteoffset, store.byteoffset+store.bytelength), numpy.uint8)
+    data = data.view()
+    data.flags.writeable = False
+    return data
+
+def unpack_bits(bits, signs=False):
+    """The bits of a bit string as a NumPy array of 0s and 1s, or, if signs
+    is set, of -1s and 1s"""
+    values = numpy.unpackbits(bytes_view(bits))[:len(bits)]
+    if signs:
+        values = values.astype(numpy.int8)
+        values *= 2
+        values -= 1
+    return values
+
+def array_to_bits(data, length=None):
+    """A Bits of the first length bits, or all, of a NumPy array of bytes,
+    which shares the array rather than copying it. The array must not be 
+    changed while the Bits is in use."""
+    data = numpy.ascontiguousarray(data, numpy.uint8).reshape(-1)
+    if length is None:
+        length = 8 * len(data)
+    if length > 8 * len(data):
+        raise ValueError("Not enough data for %d bits" % length)
+    bits = object.__new__(bitstring.Bits)
+    bits._datastore = bitstring.ConstByteStore(NumpyByteArray(data), length, 0)
+    return bits
+
+class NumpyByteArray(object):
+    """Looks like a bytearray, but reads from a NumPy array of bytes, as 
+    bitstring.MmapByteArray does from a file. Slices are copied out."""
+
+    __slots__ = ('array',)
+
+    def __init__(self, array):
+        self.array = array
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return bytearray(self.array[key])
+        return int(self.array[key])
+
+    def __len__(self):
+        return len(self.array)
+
+def num_words(nb):
+    """Number of 64-bit words needed to pack nb bits"""
+    return (nb + 63) // 64
+
+def pack_words(bits, nw=None):
+    """Returns the bit string as a NumPy array of 64-bit words, padded 
+    with zero bits to fill nw words"""
+    if nw is None:
+        nw = num_words(len(bits))
+    buf = numpy.zeros(8 * nw, numpy.uint8)
+    data = numpy.frombuffer(bits.tobytes(), numpy.uint8)
+    buf[:len(data)] = data
+    return buf.view(numpy.uint64)
+
+def as_words(sigs):
+    """A matrix of signatures packed into rows of bytes or of 64-bit words, 
+    as words. Rows of bytes are padded with zero bytes to whole words."""
+    sigs = numpy.asarray(sigs)
+    if sigs.ndim != 2:
+        raise ValueError("Signatures must be packed into the rows of a matrix")
+    if sigs.dtype == numpy.uint8:
+        if sigs.shape[1] % 8:
+            padded = numpy.zeros((len(sigs), 8 * num_words(8 * sigs.shape[1])), numpy.uint8)
+            padded[:,:sigs.shape[1]] = sigs
+            sigs = padded
+        return numpy.ascontiguousarray(sigs).view(numpy.uint64)
+    if sigs.dtype == numpy.uint64:
+        return numpy.ascontiguousarray(sigs)
+    raise TypeError("Signatures must be packed into uint8 or uint64, not %s" % sigs.dtype)
+
+def hd_matrix(A, B):
+    """Hamming distances between each row of A and each row of B, matrices
+    of signatures packed into bytes or 64-bit words, as an int32 matrix of 
+    len(A) rows and len(B) columns. The distances are computed a block at 
+    a time, so the temporaries are bounded whatever the sizes of A and B.
+    If B is A, only half of the distances are computed."""
+    symmetric = B is A
+    A, B = as_words(A), as_words(B)
+    if A.shape[1] != B.shape[1]:
+        raise ValueError("Signatures must have the same length")
+    dists = numpy.zeros((len(A), len(B)), numpy.int32)
+    if min(len(A), len(B)) < HD_MIN_GEMM_ROWS:
+        hd_xor_blocks(A, B, dists)
+    else:
+        hd_gemm_blocks(A, B, dists, symmetric)
+    return dists
+
+def hd_one_to_many(x, A):
+    """Hamming distances between a signature x and each row of A, packed 
+    as for hd_matrix, as an int32 array"""
+    return hd_matrix(numpy.asarray(x)[numpy.newaxis], A)[0]
+
+def hd_xor_blocks(A, B, dists):
+    """Fill dists as hd_matrix, counting the set bits of the XOR of each 
+    pair of signatures"""
+    nw = A.shape[1]
+    cols = max(1, min(len(B), HD_BLOCK_WORDS // max(1, nw)))
+    rows = max(1, HD_BLOCK_WORDS // (cols * max(1, nw)))
+    for j in range(0, len(B), cols):
+        for i in range(0, len(A), rows):
+            dists[i:i+rows, j:j+cols] = popcount(A[i:i+rows, numpy.newaxis] ^ B[j:j+cols])
+
+def hd_gemm_blocks(A, B, dists, symmetric=False):
+    """Fill dists as hd_matrix, by matrix multiplication. With each bit b 
+    unpacked to 1 - 2b, the dot product of two signatures of n bits is 
+    n - 2d, where d is their distance. The products are sums of +/-1, so 
+    they are exact in floating point, and BLAS computes them many times 
+    faster than the bits of the XORs can be counted. If symmetric is set, 
+    A and B are the same and only the blocks on and above the diagonal are
+    computed."""
+    nbits = 64 * A.shape[1]
+    # integers are exact in single precision up to 2**24
+    dtype = numpy.float32 if nbits < 2 ** 24 else numpy.float64
+    rows = max(1, min(HD_BLOCK_ROWS, HD_BLOCK_BITS // max(1, nbits)))
+    for j in range(0, len(B), rows):
+        signsB = unpack_signs(B[j:j+rows], dtype)
+        for i in range(0, j+1 if symmetric else len(A), rows):
+            products = unpack_signs(A[i:i+rows], dtype).dot(signsB.T)
+            products -= nbits
+            products *= -0.5
+            dists[i:i+rows, j:j+rows] = products
+            if symmetric and i != j:
+                dists[j:j+rows, i:i+rows] = products.T
+
+def unpack_signs(words, dtype):
+    """The bits of a matrix of packed words, each as 1 - 2*bit"""
+    signs = numpy.unpackbits(words.view(numpy.uint8), axis=1).astype(dtype)
+    signs *= -2
+    signs += 1
+    return signs
+
+def popcount(words):
+    """Count the set bits along the last axis of an array of packed words"""
+    words = numpy.ascontiguousarray(words)
+    return POPCOUNT16[words.view(numpy.uint16)].sum(axis=-1, dtype=numpy.int64)
+
+if __name__ == '__main__':
+    import os, timeit
+    print "Comparing hd and hw against the bitstring methods"
+    for nb in [256, 1024, 4096, 16384, 65536]:
+        a = bitstring.Bits(bytes=os.urandom(nb // 8))
+        b = bitstring.Bits(bytes=os.urandom(nb // 8))
+        assert hd(a, b) == (a ^ b).count(1) and hw(a) == a.count(1)
+        # an unaligned slice takes the bitstring path
+        assert hd(a[1:], b[1:]) == (a[1:] ^ b[1:]).count(1) and hw(a[3:]) == a[3:].count(1)
+        number = max(10, 2 ** 18 // nb)
+        before = timeit.timeit(lambda: (a ^ b).count(1), number=number) / number
+        after = timeit.timeit(lambda: hd(a, b), number=number) / number
+        print "nb = %5d: hd %8.2f us, was %8.2f us (%5.1fx)" % (nb, 1e6 * after, 1e6 * before, before / after)
+
+    print "Comparing Bits.count against counting a byte at a time"
+    for nb in [2 ** 10, 2 ** 13, 2 ** 16, 2 ** 20]:
+        a = bitstring.Bits(bytes=os.urandom(nb // 8 + 1))[3:nb+3]
+        store = a._datastore
+        # the set bits as counted by bitstring 3.0.2
+        by_byte = lambda: (sum(bitstring.BIT_COUNT[store.getbyte(i)] for i in xrange(store.bytelength - 1)) -
+                bitstring.BIT_COUNT[store.getbyte(0) >> (8 - store.offset)] +
+                bitstring.BIT_COUNT[store.getbyte(store.bytelength - 1) >> (8 * store.bytelength - store.offset - nb)])
+        assert a.count(1) == by_byte() == a.bin.count('1')
+        number = max(3, 2 ** 20 // nb)
+        before = timeit.timeit(by_byte, number=number) / number
+        after = timeit.timeit(lambda: a.count(1), number=number) / number
+        print "nb = %7d: count %9.1f us, was %9.1f us (%5.1fx)" % (nb, 1e6 * after, 1e6 * before, before / after)
+
+    print "Comparing the &, | and ^ operators against combining a byte at a time"
+    for nb in [2 ** 10, 2 ** 13, 2 ** 16]:
+        a = bitstring.Bits(bytes=os.urandom(nb // 8))
+        b = bitstring.Bits(bytes=os.urandom(nb // 8))
+        # an unaligned slice takes the byte at a time path
+        assert (a ^ b) == a._copy()._ixor(b) and (a | b) == a._copy()._ior(b) and (a & b) == a._copy()._iand(b)
+        assert (a[1:] ^ b[1:]) == (a ^ b)[1:] and type(bitstring.BitArray(a) ^ b) is bitstring.BitArray
+        number = max(10, 2 ** 20 // nb)
+        before = timeit.timeit(lambda: a._copy()._ixor(b), number=number) / number
+        after = timeit.timeit(lambda: a ^ b, number=number) / number
+        print "nb = %7d: a ^ b %9.1f us, was %9.1f us (%5.1fx)" % (nb, 1e6 * after, 1e6 * before, before / after)
+
+    import sys, time
+    numChips = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    print "Computing the distance matrix of %d chips" % numChips
+    for nb in [256, 1024]:
+        sigs = numpy.frombuffer(os.urandom(numChips * nb // 8), numpy.uint8).reshape(numChips, nb // 8)
+        startTime = time.time()
+        dists = hd_matrix(sigs, sigs)
+        print "nb = %5d: %8.3f s" % (nb, time.time() - startTime)
+        words = as_words(sigs)
+        check = numpy.random.randint(0, numChips, 16)
+        assert (dists[check] == popcount(words[check, numpy.newaxis] ^ words)).all()
+        assert (dists == dists.T).all() and not dists.diagonal().any()
+        assert (hd_one_to_many(sigs[check[0]], sigs) == dists[check[0]]).all()
@@ -31,24 +31,204 @@ __version__ = "1.2"
 
 __author__ = "Ryan Helinski and Mitch Martin"
 
-import os, subprocess, glob, time
+import os, subprocess, glob, time, math, json, struct, zlib, threading
+import numpy
 from bitstring import Bits, BitStream
 import bitstringutils
+from hammingindex import MultiIndexHash
+from signaturepool import SignaturePool
+import signaturepool
+from sqlitestore import SQLiteStore, PagedList
 import xml.etree.ElementTree as etree
 from xml.etree.ElementTree import ParseError
+try:
+    # the C parser streams large files several times faster
+    from xml.etree.cElementTree import iterparse, ParseError as CParseError
+except ImportError:
+    from xml.etree.ElementTree import iterparse
+    CParseError = ParseError
+
+class DistRing(object):
+    """A preallocated circular buffer of distance samples. Each sample is a 
+    row of one distance per column; columns keep their own fill count since 
+    they may start receiving samples at different times. The number, sum 
+    and sum of squares of the samples held are kept up to date as samples 
+    are appended and evicted, as are the counts in hist, if given, a 
+    histogram of distances shared with other buffers."""
+
+    def __init__(self, depth, width=1, dtype=numpy.uint16, hist=None):
+        self.depth = depth
+        self.hist = hist
+        self.data = numpy.zeros((depth, width), dtype)
+        self.counts = numpy.zeros(width, numpy.int32)
+        self.head = 0 # the slot written by the next append
+        self.num = 0
+        self.total = 0
+        self.total_sq = 0
+
+    def __len__(self):
+        return self.num
+
+    def mean(self):
+        return float(self.total)/max(1, self.num)
+
+    def var(self):
+        return max(0.0, float(self.total_sq)/max(1, self.num) - self.mean()**2)
+
+    def update_totals(self, added, removed):
+        added = added.astype(numpy.int64)
+        removed = removed.astype(numpy.int64)
+        self.num += len(added) - len(removed)
+        self.total += int(added.sum()) - int(removed.sum())
+        self.total_sq += int((added*added).sum()) - int((removed*removed).sum())
+        if self.hist is not None:
+            self.hist += numpy.bincount(added, minlength=len(self.hist))
+            self.hist -= numpy.bincount(removed, minlength=len(self.hist))
+
+    def grow(self, width):
+        """Make room for at least width columns"""
+        if width > self.data.shape[1]:
+            width = max(width, 2*self.data.shape[1])
+            data = numpy.zeros((self.depth, width), self.data.dtype)
+            data[:,:self.data.shape[1]] = self.data
+            self.data = data
+            self.counts = numpy.concatenate((self.counts, numpy.zeros(width-len(self.counts), numpy.int32)))
+
+    def append(self, values, skip=None):
+        """Append one sample to the first len(values) columns. The column 
+        skip, if given, must not hold any samples and gets none. Each append 
+        is O(width)."""
+        self.grow(len(values))
+        counts = self.counts[:len(values)]
+        evicted = self.data[self.head,:len(values)][counts == self.depth]
+        self.data[self.head,:len(values)] = values
+        counts += counts < self.depth
+        if skip is not None:
+            counts[skip] = 0
+            values = numpy.delete(values, skip)
+        self.update_totals(values, evicted)
+        self.head = (self.head + 1) % self.depth
+
+    def extend(self, samples, widths, skip=None):
+        """Append the rows of a matrix of samples, with the same result as
+        append(samples[i,:widths[i]], skip) for each row i in turn. The
+        widths must not decrease. Each extend is O(width*(depth+rows))."""
+        if len(samples) > self.depth:
+            for start in range(0, len(samples), self.depth):
+                self.extend(samples[start:start+self.depth], widths[start:start+self.depth], skip)
+            return
+        if len(samples) == 0:
+            return
+        num, width = len(samples), widths[-1]
+        self.grow(width)
+        columns = numpy.arange(width)
+        old, old_counts = self.get_columns(columns)
+        # each column gets the samples from the first row wide enough on
+        first = numpy.searchsorted(widths, columns, side='right')
+        if skip is not None:
+            first[skip] = num
+        counts = old_counts + num - first
+        # lay out the samples of each column after those it holds, oldest first
+        series = numpy.zeros((width, self.depth + num), self.data.dtype)
+        series[:,:self.depth] = old
+        rows = numpy.arange(num)
+        new = rows >= first[:,numpy.newaxis]
+        slots = old_counts[:,numpy.newaxis] + rows - first[:,numpy.newaxis]
+        series[numpy.nonzero(new)[0], slots[new]] = samples[:,:width].T[new]
+        kept = numpy.minimum(counts, self.depth)
+        slots = numpy.arange(self.depth + num)
+        held = (slots >= (counts - kept)[:,numpy.newaxis]) & (slots < counts[:,numpy.newaxis])
+        values = series[held]
+        removed = old[numpy.arange(self.depth) < old_counts[:,numpy.newaxis]]
+        self.head = (self.head + num) % self.depth
+        self.data[((self.head - counts[:,numpy.newaxis] + slots) % self.depth)[held], numpy.repeat(columns, kept)] = values
+        self.counts[:width] = kept
+        self.update_totals(values, removed)
+
+    def get(self, column=0):
+        """Samples held for one column, oldest first"""
+        count = self.counts[column] if column < len(self.counts) else 0
+        return self.data[(self.head - count + numpy.arange(count)) % self.depth, column]
+
+    def set(self, column, values):
+        """Replace the samples of a column, keeping only the most recent ones"""
+        values = numpy.asarray(values[-self.depth:], self.data.dtype)
+        self.grow(column+1)
+        self.update_totals(values, self.get(column))
+        self.data[(self.head - len(values) + numpy.arange(len(values))) % self.depth, column] = values
+        self.counts[column] = len(values)
+
+    def get_columns(self, columns):
+        """Samples held for an array of columns, as the rows of a matrix of 
+        depth columns, oldest first and zero-padded on the right, along with 
+        the number held for each column"""
+        columns = numpy.asarray(columns, int)
+        counts = self.counts[columns]
+        slots = numpy.arange(self.depth)
+        dists = self.data[(self.head - counts[:,numpy.newaxis] + slots) % self.depth, columns[:,numpy.newaxis]]
+        dists[slots >= counts[:,numpy.newaxis]] = 0
+        return dists, counts
+
+    def set_columns(self, columns, dists, counts):
+        """Replace the samples of an array of columns with the rows of a 
+        matrix laid out as returned by get_columns, keeping only the most 
+        recent samples of each"""
+        columns = numpy.asarray(columns, int)
+        counts = numpy.asarray(counts, int)
+        kept = numpy.minimum(counts, self.depth)
+        self.grow(columns.max()+1 if len(columns) else 0)
+        old, old_counts = self.get_columns(columns)
+        removed = old[numpy.arange(self.depth) < old_counts[:,numpy.newaxis]]
+        slots = numpy.arange(dists.shape[1])
+        held = (slots >= (counts - kept)[:,numpy.newaxis]) & (slots < counts[:,numpy.newaxis])
+        rows = (self.head - counts[:,numpy.newaxis] + slots) % self.depth
+        values = numpy.asarray(dists[held], self.data.dtype)
+        self.data[rows[held], numpy.repeat(columns, kept)] = values
+        self.counts[columns] = kept
+        self.update_totals(values, removed)
+
+    def columns(self):
+        """Indices of the columns holding any samples"""
+        return numpy.flatnonzero(self.counts)
+
+    def values(self):
+        """All samples held in the buffer, in no particular order"""
+        age = (self.head - 1 - numpy.arange(self.depth)) % self.depth
+        return self.data[age[:,numpy.newaxis] < self.counts[numpy.newaxis,:]]
 
 class ChipIdentify:
     """This class is used to identify a chip's name based on a database of PUF signatures"""
 
     # static variables
     max_num_dists = 64 # should be at least 64 in practice
+    alias_refit_interval = 64 # measurements between refits of the gamma aliasing model, 1 refits on every one
+    alias_estimator = 'gamma' # one of alias_estimators
+    noise_quantile = 0.997 # fraction of noise distances within the aliasing threshold
+    max_journal_size = 2 ** 22 # bytes of journal records before they are compacted into the file
+    sqlite_batch_size = 16 # measurements written to an SQLite database per transaction
+    max_delta_fraction = 0.25 # fraction of the chips changed before they are all saved
+    min_bounded_rows = 2048 # chips below which bounded_nearest scans them all without a bound
     
-    def __init__(self, fileName = "chipsignatures.xml", nb=1024):
+    def __init__(self, fileName = "chipsignatures.xml", nb=1024, useIndex=False):
         self.nb = nb
         self.fileName = fileName
+        # Optionally keep a multi-index hash so that Identify can find chips 
+        # within a radius without scanning the whole database
+        self.useIndex = useIndex
+        self.journalFile = None
+        # The data is changed while holding lock, so that it can be saved 
+        # from a background thread, and saves are serialized by saveLock
+        self.lock = threading.RLock()
+        self.saveLock = threading.Lock()
+        self.autosaver = None
+        # A pool of processes which search the signatures, see start_pool
+        self.pool = None
+        # An SQLite database is updated in place, by rewriting the rows of 
+        # the dirty chips
+        self.store = None
         self.setup()
 
-        if (os.path.isfile(self.fileName)):
+        if (os.path.isfile(self.fileName) or os.path.isfile(self.journal_name())):
             self.load()
             print "Using signature database at '%s' with %d chip signatures" % (self.fileName, len(self))
         else:
@@ -57,252 +237,1356 @@ class ChipIdentify:
                 os.makedirs(os.path.split(self.fileName)[0])
 
     def setup(self):
-        # To map chip names to signatures:
-        self.signatureMap = dict()
-        # For each chip, we also want to have a list of noise and inter-chip distances
-        self.noiseDistMap = dict()
-        self.interChipDistMap = dict()
-        # To keep track of the unstable bit positions
-        self.unstableBits = dict()
-        self.measCount = dict()
+        # Chips are numbered from 0 in the order they are enrolled, and the
+        # data of each chip is held in arrays and lists indexed by its number,
+        # or id. The names are kept only to look up ids, in chipIndex, and
+        # the other way, in chipNames.
+        self.chipNames = []
+        self.chipIndex = dict()
+        # Enrolled signatures are packed into the rows of one matrix of 64-bit
+        # words so that a measurement can be compared against all of them at
+        # once. The arrays indexed by id have room for more chips than are
+        # enrolled, see reserve.
+        self.nw = bitstringutils.num_words(self.nb)
+        self.sigMatrix = self.new_sig_matrix(16)
+        self.index = MultiIndexHash(self.nw) if self.useIndex else None
+        # Distances fit in 16 bits unless the responses are very long
+        self.distType = numpy.uint16 if self.nb < 2 ** 16 else numpy.uint32
+        # For each chip, we also want to have a history of noise and inter-chip 
+        # distances. These are held in DistRings of depth max_num_dists, or
+        # None until the chip has one. The columns of the inter-chip rings
+        # are ids.
+        self.noiseDistRings = []
+        self.interChipDistRings = []
+        # Histograms of all the distances held in these, over the population
+        self.noiseDistHist = numpy.zeros(self.nb+1, numpy.int64)
+        self.interChipDistHist = numpy.zeros(self.nb+1, numpy.int64)
+        # To keep track of the unstable bit positions, the number of times
+        # each bit has differed from the enrolled signature, and of which
+        # chips have been measured since enrolment. A bit is unstable if it
+        # has ever flipped.
+        self.flipCounts = numpy.zeros((16, self.nb), numpy.uint16)
+        self.unstableFlags = numpy.zeros(16, bool)
+        self.measCounts = numpy.zeros(16, numpy.int64)
+        # Counts the measurements processed, so that results derived from the 
+        # distance histories can be cached until they change
+        self.version = 0
+        self.aliasFit = None
+        # The ids of the chips changed since the database was last written in
+        # whole, or since an SQLite database was last updated, and the number
+        # of changes since the last save
+        self.dirty = set()
+        self.numPending = 0
+        # The sequence number of the last journal record
+        self.journalSeq = 0
+        self.close_store()
+
+    def reserve(self, num):
+        """Make room for num chips in the arrays indexed by id. These grow
+        geometrically so that enrolment is amortized O(1)."""
+        if num <= len(self.sigMatrix):
+            return
+        size = max(num, 2*len(self.sigMatrix))
+        for attr in ['sigMatrix', 'flipCounts', 'unstableFlags', 'measCounts']:
+            old = getattr(self, attr)
+            if attr == 'sigMatrix':
+                new = self.new_sig_matrix(size)
+            else:
+                new = numpy.zeros((size,) + old.shape[1:], old.dtype)
+            new[:len(old)] = old
+            setattr(self, attr, new)
+
+    def new_sig_matrix(self, num):
+        """A signature matrix of num rows, all zero, in the shared memory of 
+        the pool if there is one"""
+        if self.pool is not None:
+            return self.pool.allocate(num)
+        return numpy.zeros((num, self.nw), numpy.uint64)
+
+    def start_pool(self, processes=None):
+        """Search the signatures with a pool of processes, one per core by 
+        default, each of which searches a shard of the signature matrix. The 
+        matrix is moved to shared memory, so it is not copied per search."""
+        with self.lock:
+            self.stop_pool()
+            pool = SignaturePool(self.nw, processes)
+            sigMatrix = pool.allocate(len(self.sigMatrix))
+            sigMatrix[:] = self.sigMatrix
+            self.pool, self.sigMatrix = pool, sigMatrix
+
+    def stop_pool(self):
+        with self.lock:
+            if self.pool is not None:
+                self.sigMatrix = self.sigMatrix.copy()
+                self.pool.close()
+                self.pool = None
 
     def clear(self):
-        self.setup()
+        # a write in progress may still be using the SQLite connection
+        with self.saveLock:
+            with self.lock:
+                self.setup()
+        self.save()
+
+    def close(self):
+        """Save the database and stop using it"""
+        self.stop_autosave()
         self.save()
+        with self.saveLock:
+            with self.lock:
+                self.close_journal()
+                self.close_store()
 
     def __len__(self):
-        return len(self.signatureMap)
-            
+        return len(self.chipNames)
+
     def load(self):
-        """Load data from file"""
+        """Load data from file, in the format given by db_format, then the
+        chips in the delta file, if it is newer, then replay the journal"""
+        if os.path.isfile(self.fileName):
+            if db_format(self.fileName) == 'xml':
+                self.journalSeq = self.load_xml(self.fileName)
+            elif db_format(self.fileName) == 'sqlite':
+                self.load_sqlite(self.fileName)
+            else:
+                self.journalSeq, rows = self.load_binary(self.fileName)
+        if os.path.isfile(self.delta_name()) and read_header(self.delta_name())['journal_seq'] > self.journalSeq:
+            self.journalSeq, rows = self.load_binary(self.delta_name())
+            self.dirty.update(rows.tolist())
+        self.replay_journal()
+
+    def save(self, altFileName=None, changesOnly=False):
+        """Write the database to file, which compacts the journal. With
+        changesOnly, only the chips changed since the whole database was
+        last written are, to the delta file, until they are more than
+        max_delta_fraction of the chips. An SQLite database already open
+        is only ever updated with the chips changed since its last update.
+        The data is gathered while holding the lock and written after
+        releasing it, so that measurements can be processed meanwhile."""
+        with self.saveLock:
+            with self.lock:
+                self.close_journal()
+                if altFileName != None:
+                    self.fileName = altFileName
+                fmt = db_format(self.fileName)
+                seq = self.journalSeq
+                delta = fmt != 'sqlite' and changesOnly and os.path.isfile(self.fileName) and \
+                    len(self.dirty) <= self.max_delta_fraction * len(self.chipNames)
+                if delta:
+                    write = self.binary_writer(self.delta_name(), sorted(self.dirty))
+                elif fmt == 'xml':
+                    write = self.xml_writer(self.fileName)
+                elif fmt == 'sqlite':
+                    write = self.sqlite_writer(self.fileName)
+                else:
+                    write = self.binary_writer(self.fileName)
+                if not delta:
+                    written, self.dirty = self.dirty, set()
+                self.numPending = 0
+            try:
+                write()
+            except:
+                if not delta:
+                    with self.lock:
+                        self.dirty.update(written)
+                raise
+            with self.lock:
+                if fmt != 'sqlite':
+                    if not delta and os.path.isfile(self.delta_name()):
+                        os.remove(self.delta_name())
+                    self.trim_journal(seq)
+
+    def start_autosave(self, count=64, interval=30.0):
+        """Save the changes from a background thread, see AutoSaver"""
+        self.stop_autosave()
+        self.autosaver = AutoSaver(self, count, interval)
+        self.autosaver.start()
+
+    def stop_autosave(self):
+        if self.autosaver is not None:
+            self.autosaver.stop()
+            self.autosaver = None
+
+    def journal_name(self):
+        return self.fileName + '.journal'
+
+    def delta_name(self):
+        return self.fileName + '.delta'
+
+    def journal(self, kind, row, sig):
+        """Mark a chip as changed and append a record to the journal.
+        Enrolments and measurements are journaled as they are made rather
+        than rewriting the whole file, and replayed when the file is next
+        loaded. Each record is a header of the sequence number and kind of
+        the record, the lengths of the chip name and signature and a CRC
+        of the record, followed by the name and the signature bytes.
+        An SQLite database is written to instead, sqlite_batch_size records 
+        at a time, unless autosave is on."""
+        self.journal_many(kind, [row], [sig])
+
+    def journal_many(self, kind, rows, sigs):
+        """Journal records of one kind for the chips with ids rows. They are
+        written together, the database is not saved until all of them are."""
+        self.dirty.update(rows)
+        self.numPending += len(rows)
+        if db_format(self.fileName) != 'sqlite':
+            if self.journalFile is None:
+                self.journalFile = open(self.journal_name(), 'ab')
+            for row, sig in zip(rows, sigs):
+                self.journalSeq += 1
+                self.journalFile.write(journal_record(self.journalSeq, kind, self.chipNames[row], sig))
+            self.journalFile.flush()
+            full = self.journalFile.tell() > self.max_journal_size
+        else:
+            full = self.store is None or self.numPending >= self.sqlite_batch_size
+        if self.autosaver is not None:
+            self.autosaver.notify(compact=full and db_format(self.fileName) != 'sqlite')
+        elif full:
+            self.save()
+
+    def close_journal(self):
+        if self.journalFile is not None:
+            self.journalFile.close()
+            self.journalFile = None
+
+    def close_store(self):
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+
+    def read_journal(self):
+        """Returns the records in the journal, as (start, end, sequence
+        number, kind, chip name, signature), and the number of bytes of
+        valid records. A truncated or corrupt record, as left by a crash
+        while it was written, ends the journal."""
+        if not os.path.isfile(self.journal_name()):
+            return [], 0
+        journalFile = open(self.journal_name(), 'rb')
+        data = journalFile.read()
+        journalFile.close()
+        header_len = struct.calcsize(JOURNAL_HEADER)
+        records = []
+        pos = 0
+        while pos + header_len <= len(data):
+            seq, kind, name_len, sig_len, crc = struct.unpack_from(JOURNAL_HEADER, data, pos)
+            start = pos + header_len
+            end = start + name_len + (sig_len + 7) // 8
+            payload = data[start:end]
+            if end > len(data) or crc != journal_crc(seq, kind, name_len, sig_len, payload):
+                break
+            records.append((pos, end, seq, kind, decode_name(payload[:name_len]), Bits(bytes=payload[name_len:], length=sig_len)))
+            pos = end
+        if pos < len(data):
+            print "WARNING: Discarding %d bytes of corrupt journal records in '%s'" % (len(data) - pos, self.journal_name())
+        return records, pos
+
+    def replay_journal(self):
+        """Apply the records in the journal newer than the file, in order"""
+        records, valid = self.read_journal()
+        if os.path.isfile(self.journal_name()) and valid < os.path.getsize(self.journal_name()):
+            # so that records appended from now on are not lost behind them
+            journalFile = open(self.journal_name(), 'r+b')
+            journalFile.truncate(valid)
+            journalFile.close()
+        num = 0
+        for start, end, seq, kind, chip_name, sig in records:
+            if seq <= self.journalSeq:
+                continue
+            if kind == 'E':
+                self.add(chip_name, sig, journal=False)
+            elif kind == 'M':
+                self.process_sig(chip_name, sig, journal=False)
+            else:
+                raise NameError('Unsupported journal record %r' % kind)
+            self.dirty.add(self.chipIndex[chip_name])
+            self.journalSeq = seq
+            num += 1
+        if num:
+            print "Replayed %d journal records from '%s'" % (num, self.journal_name())
+
+    def trim_journal(self, seq):
+        """Drop the journal records up to seq, which have been saved"""
+        self.close_journal()
+        if self.journalSeq == seq:
+            if os.path.isfile(self.journal_name()):
+                os.remove(self.journal_name())
+            return
+        records, valid = self.read_journal()
+        keep = [start for start, end, record_seq, kind, chip_name, sig in records if record_seq > seq]
+        if keep:
+            journalFile = open(self.journal_name(), 'rb')
+            journalFile.seek(keep[0])
+            tail = journalFile.read(valid - keep[0])
+            journalFile.close()
+            write_file(self.journal_name(), tail)
+
+    def import_xml(self, fileName):
+        """Merge in the chips of an XML database, and save them. They are 
+        not journaled, so they would be lost on a crash until then."""
+        with self.lock:
+            self.load_xml(fileName)
+            self.dirty.update(range(len(self.chipNames)))
+            # the distance histograms may have changed a lot, fit the 
+            # aliasing model afresh
+            self.version += 1
+            self.aliasFit = None
+        self.save()
+
+    def export_xml(self, fileName):
+        """Write the database to an XML file, without switching to that file"""
+        with self.lock:
+            write = self.xml_writer(fileName)
+        write()
+
+    def load_xml(self, fileName):
+        """Load data from an XML file. The file is parsed as a stream and 
+        each <chip> element is discarded once it has been read, so the 
+        document is never held in memory as a whole. Returns the sequence
+        number of the last journal record saved in the file."""
+        startTime = time.time()
+        # inter-chip distances can refer to chips further down the list
+        inter_dists = []
+        depth = 0
+        seq = 0
         try:
-            mytree = etree.parse(self.fileName)
-        except ParseError as pe:
+            for event, element in iterparse(fileName, events=('start', 'end')):
+                if event == 'start':
+                    depth += 1
+                    if depth == 1:
+                        myroot = element
+                        if myroot.tag != 'chip_list':
+                            raise NameError('Expecting this XML file to contain one <chip_list> element as its root')
+                        seq = int(myroot.get('journal_seq', 0))
+                    elif depth == 2 and element.tag != 'chip':
+                        raise NameError('<chip_list> element must contain only <chip> elements')
+                else:
+                    depth -= 1
+                    if depth == 1:
+                        self.load_chip_element(element, inter_dists)
+                        # drop the elements read so far
+                        myroot.clear()
+        except (ParseError, CParseError) as pe:
+            # keep the chips read before the error
             print pe
-            return
 
-        myroot = mytree.getroot()
-
-        if myroot.tag != 'chip_list':
-            raise NameError('Expecting this XML file to contain one <chip_list> element as its root')
-
-        for subelement in myroot:
-            if subelement.tag != 'chip':
-                raise NameError('<chip_list> element must contain only <chip> elements')
-            self.measCount[subelement.get('name')] = int(subelement.get('meas_count')) if 'meas_count' in subelement.attrib else 1
-            for subsub in subelement:
-                if subsub.tag == 'sig':
-                    if subsub.attrib['encoding'] != 'hex':
-                        raise NameError('Only hex encoding supported, add "encoding=hex" and use a hex string')
-                    self.signatureMap[subelement.get('name')] = Bits("0x"+subsub.text)
-
-                elif subsub.tag == 'noise':
-                    if subelement.get('name') not in self.noiseDistMap:
-                        self.noiseDistMap[subelement.get('name')] = []
-                    for noise_dist in subsub:
-                        if noise_dist.tag != 'dist':
-                            raise NameError('Tags under <noise> must be <dist>')
-                        self.noiseDistMap[subelement.get('name')].append(int(noise_dist.text))
-
-                elif subsub.tag == 'inter_chip':
-                    if subelement.get('name') not in self.interChipDistMap:
-                        self.interChipDistMap[subelement.get('name')] = dict()
-                    for other_name in subsub:
-                        if other_name.tag != 'other':
-                            raise NameError('Tags under <inter_chip> must be <other>')
-                        if other_name.get('name') not in self.interChipDistMap[subelement.get('name')]:
-                            self.interChipDistMap[subelement.get('name')][other_name.get('name')] = []
-                        for other_dist in other_name:
-                            if other_dist.tag != 'dist':
-                                raise NameError('Tags under <other> must be <dist>')
-                            self.interChipDistMap[subelement.get('name')][other_name.get('name')].append(int(other_dist.text))
-
-                elif subsub.tag == 'unstable_bits':
-                    if subsub.attrib['encoding'] != 'hex':
-                        raise NameError('Only hex encoding supported, add "encoding=hex" and use a hex string')
-                    self.unstableBits[subelement.get('name')] = Bits("0x"+subsub.text)
+        for row, other_names, counts, dists in inter_dists:
+            known = numpy.array([other_name in self.chipIndex for other_name in other_names], bool)
+            others = [self.chipIndex[other_name] for other_name in numpy.array(other_names, object)[known]]
+            self.interChipDistRings[row].set_columns(others, dists[known], counts[known])
+
+        loadTime = time.time() - startTime
+        print "Loaded %d chips from '%s' in %.2f s (%.0f chips/s)" % (
+            len(self), fileName, loadTime, len(self) / max(loadTime, 1e-6))
+        return seq
 
+    def load_chip_element(self, chipEl, inter_dists):
+        """Read one <chip> element. Its inter-chip distances are appended to 
+        inter_dists, as (id, other names, counts, distances), to be stored
+        once all the chips are known."""
+        name = chipEl.get('name')
+        sigEl = chipEl.find('sig')
+        if sigEl is None:
+            raise NameError('<chip> element must contain a <sig> element')
+        if sigEl.attrib['encoding'] != 'hex':
+            raise NameError('Only hex encoding supported, add "encoding=hex" and use a hex string')
+        row = self.set_sig(name, Bits("0x"+sigEl.text))
+        self.measCounts[row] = int(chipEl.get('meas_count')) if 'meas_count' in chipEl.attrib else 1
+        for subsub in chipEl:
+            if subsub.tag == 'sig':
+                continue
+
+            elif subsub.tag == 'noise':
+                noise_dists = self.read_dists(subsub, 'noise')
+                self.noiseDistRings[row] = self.new_noise_ring()
+                self.noiseDistRings[row].set(0, noise_dists)
+
+            elif subsub.tag == 'inter_chip':
+                if self.interChipDistRings[row] is None:
+                    self.interChipDistRings[row] = self.new_inter_chip_ring()
+                other_names = []
+                other_dists = []
+                for other_name in subsub:
+                    if other_name.tag != 'other':
+                        raise NameError('Tags under <inter_chip> must be <other>')
+                    other_names.append(other_name.get('name'))
+                    other_dists.append(self.read_dists(other_name, 'other'))
+                counts = numpy.array([len(dists) for dists in other_dists], int)
+                dists = numpy.zeros((len(other_dists), max([0] + counts.tolist())), self.distType)
+                for i, other in enumerate(other_dists):
+                    dists[i, :len(other)] = other
+                inter_dists.append((row, other_names, counts, dists))
+
+            elif subsub.tag == 'unstable_bits':
+                if subsub.attrib['encoding'] != 'hex':
+                    raise NameError('Only hex encoding supported, add "encoding=hex" and use a hex string')
+                if 'flip_counts' in subsub.attrib:
+                    self.flipCounts[row] = numpy.frombuffer(subsub.get('flip_counts').decode('hex'), '>u2')
                 else:
-                    raise NameError('Unsupported tag %s' % subsub.tag)
-        
-    def save(self, altFileName=None):
-        if altFileName != None: 
-            self.fileName = altFileName
-        chipListEl = etree.Element('chip_list')
-        chipListEl.text = "\n\t"
-        for name, sig in sorted(self.signatureMap.items(), key=lambda item: item[0] ):
-            chipEl = etree.SubElement(chipListEl, 'chip', attrib={'name':name, 'meas_count':str(self.measCount[name])})
-            chipEl.text = "\n" + 2*"\t"
-            chipEl.tail = "\n" + "\t"
-            sigEl = etree.SubElement(chipEl, 'sig', attrib={'encoding':'hex'})
-            sigEl.text = sig.hex
-            sigEl.tail = "\n" + 2*"\t"
-            if name in self.noiseDistMap:
-                noiseListEl = etree.SubElement(chipEl, 'noise')
-                noiseListEl.tail = "\n" + 2*"\t"
-                for dist in self.noiseDistMap[name]:
-                    noiseEl = etree.SubElement(noiseListEl, 'dist')
-                    noiseEl.text = str(dist)
-            if name in self.interChipDistMap:
-                interListEl = etree.SubElement(chipEl, 'inter_chip')
-                interListEl.text = "\n" + 3*"\t"
-                interListEl.tail = "\n" + 2*"\t"
-                for other_name, dist_list in sorted(self.interChipDistMap[name].items(), key=lambda item: item[0] ):
-                    otherNameEl = etree.SubElement(interListEl, 'other')
-                    otherNameEl.attrib['name'] = other_name
-                    otherNameEl.tail = "\n" + 3*"\t"
-                    for dist in dist_list:
-                        interEl = etree.SubElement(otherNameEl, 'dist')
-                        interEl.text = str(dist)
-                otherNameEl.tail = "\n" + 2*"\t"
-
-            if name in self.unstableBits:
-                unstableBitsEl = etree.SubElement(chipEl, 'unstable_bits', attrib={'encoding':'hex'})
-                unstableBitsEl.text = self.unstableBits[name].hex
-                unstableBitsEl.tail = "\n" + "\t"
-
-        chipEl.tail = "\n"
-                        
-        print 'Saving chip signature database to \'%s\'' % self.fileName
-        xmlfile = open(self.fileName, 'w')
-        #xml_extras.indent(chipListEl) # add white space to XML DOM to result in pretty printed string
-        xmlfile.write('<?xml version="1.0" encoding="UTF-8" ?>\n' + etree.tostring(chipListEl))
-        xmlfile.flush()
-        xmlfile.close() # don't need to sync because we close here
-
-    def Identify(self, bits):
-        "This compares a bit string against all known chip signatures and returns the closest match"
-
-        hd_dict = self.MatchMap(bits)
-        return min(hd_dict.items(), key=lambda item: item[1]) 
+                    # older files have no flip counts, count one flip per unstable bit
+                    unstable = self.unpack_flips(bitstringutils.pack_words(Bits("0x"+subsub.text), self.nw))
+                    self.flipCounts[row] = numpy.maximum(self.flipCounts[row], unstable)
+                self.unstableFlags[row] = True
+
+            elif subsub.tag == 'flip_counts':
+                # as briefly written before the counts became an attribute
+                if subsub.attrib['encoding'] != 'hex':
+                    raise NameError('Only hex encoding supported, add "encoding=hex" and use a hex string')
+                self.flipCounts[row] = numpy.frombuffer(subsub.text.strip().decode('hex'), '>u2')
+                self.unstableFlags[row] = True
+
+            else:
+                raise NameError('Unsupported tag %s' % subsub.tag)
+
+    def read_dists(self, listEl, tag):
+        """The <dist> values under an element, as an array"""
+        for dist in listEl:
+            if dist.tag != 'dist':
+                raise NameError('Tags under <%s> must be <dist>' % tag)
+        return numpy.array([int(dist.text) for dist in listEl], self.distType)
+
+    def save_xml(self, fileName):
+        """Save data to an XML file"""
+        self.xml_writer(fileName)()
+
+    def xml_writer(self, fileName):
+        """Returns a function which writes the data, as it is now, to an
+        XML file. The data is copied out now, the XML built by the function."""
+        chips = []
+        for row in sorted(range(len(self.chipNames)), key=self.chipNames.__getitem__):
+            noise = self.noiseDistRings[row].get() if self.noiseDistRings[row] is not None else None
+            inter = None
+            if self.interChipDistRings[row] is not None:
+                ring = self.interChipDistRings[row]
+                dists, counts = ring.get_columns(ring.columns())
+                inter = [(self.chipNames[column], dists[i,:counts[i]]) for i, column in enumerate(ring.columns())]
+            flips = self.flipCounts[row].copy() if self.unstableFlags[row] else None
+            chips.append((self.chipNames[row], int(self.measCounts[row]), self.unpack(self.sigMatrix[row]), noise, inter, flips))
+        journalSeq = self.journalSeq
+
+        def write():
+            chipListEl = etree.Element('chip_list')
+            chipListEl.text = "\n\t"
+            if journalSeq:
+                chipListEl.attrib['journal_seq'] = str(journalSeq)
+            for name, meas_count, sig, noise, inter, flips in chips:
+                chipEl = etree.SubElement(chipListEl, 'chip', attrib={'name':name, 'meas_count':str(meas_count)})
+                chipEl.text = "\n" + 2*"\t"
+                chipEl.tail = "\n" + "\t"
+                sigEl = etree.SubElement(chipEl, 'sig', attrib={'encoding':'hex'})
+                sigEl.text = sig.hex
+                sigEl.tail = "\n" + 2*"\t"
+                if noise is not None:
+                    noiseListEl = etree.SubElement(chipEl, 'noise')
+                    noiseListEl.tail = "\n" + 2*"\t"
+                    for dist in noise.tolist():
+                        noiseEl = etree.SubElement(noiseListEl, 'dist')
+                        noiseEl.text = str(dist)
+                if inter is not None:
+                    interListEl = etree.SubElement(chipEl, 'inter_chip')
+                    interListEl.text = "\n" + 3*"\t"
+                    interListEl.tail = "\n" + 2*"\t"
+                    for other_name, dists in sorted(inter, key=lambda item: item[0]):
+                        otherNameEl = etree.SubElement(interListEl, 'other')
+                        otherNameEl.attrib['name'] = other_name
+                        otherNameEl.tail = "\n" + 3*"\t"
+                        for dist in dists.tolist():
+                            interEl = etree.SubElement(otherNameEl, 'dist')
+                            interEl.text = str(dist)
+                    otherNameEl.tail = "\n" + 2*"\t"
+
+                if flips is not None:
+                    # the flip counts are an attribute, which older versions ignore
+                    unstableBitsEl = etree.SubElement(chipEl, 'unstable_bits', attrib={'encoding':'hex',
+                        'flip_counts':flips.astype('>u2').tostring().encode('hex')})
+                    unstableBitsEl.text = self.unstable_bits(flips).hex
+                    unstableBitsEl.tail = "\n" + "\t"
+
+            chipEl.tail = "\n"
+
+            print 'Saving chip signature database to \'%s\'' % fileName
+            #xml_extras.indent(chipListEl) # add white space to XML DOM to result in pretty printed string
+            write_file(fileName, '<?xml version="1.0" encoding="UTF-8" ?>\n' + etree.tostring(chipListEl))
+        return write
+
+    def load_binary(self, fileName):
+        """Load data from a binary database file. The file is mapped into 
+        memory and its arrays copied out whole, there is nothing to parse 
+        but the header. Returns the sequence number of the last journal
+        record saved in the file and an array of the ids of the chips read."""
+        header, arrays = map_arrays(fileName)
+        if header['nb'] != self.nb:
+            raise NameError('Database holds %d-bit signatures, expecting %d' % (header['nb'], self.nb))
+
+        # The file may hold the data of only some of the chips, the rows array 
+        # gives the row of each, but the names of all of the chips, to which 
+        # the inter-chip distances refer
+        all_names = read_names(arrays)
+        names = [all_names[row] for row in arrays['rows'].tolist()]
+        sigs = arrays['sigs']
+
+        if self.chipNames or len(names) < len(all_names):
+            # merging into a populated database, one chip at a time
+            rows = numpy.array([self.set_sig(name, self.unpack(sig)) for name, sig in zip(names, sigs)], int)
+        else:
+            rows = numpy.arange(len(names))
+            self.chipNames = names
+            self.chipIndex = dict((name, row) for row, name in enumerate(names))
+            self.reserve(len(names))
+            self.sigMatrix[rows] = sigs
+            self.noiseDistRings = [None] * len(names)
+            self.interChipDistRings = [None] * len(names)
+            if self.index is not None:
+                self.index.add_many(rows, self.sigMatrix[:len(names)])
+
+        self.measCounts[rows] = arrays['meas_count']
+        flagged = numpy.flatnonzero(arrays['unstable_flags'])
+        if 'flip_counts' in arrays:
+            self.flipCounts[rows[flagged]] = arrays['flip_counts'][flagged]
+        else:
+            # older files have no flip counts, count one flip per unstable bit
+            self.flipCounts[rows[flagged]] = self.unpack_flips(arrays['unstable_bits'][flagged])
+        self.unstableFlags[rows[flagged]] = True
+
+        noise_counts = arrays['noise_counts']
+        noise_dists = arrays['noise_dists']
+        for i in numpy.flatnonzero(noise_counts >= 0).tolist():
+            row = rows[i]
+            if self.noiseDistRings[row] is None:
+                self.noiseDistRings[row] = self.new_noise_ring()
+            self.noiseDistRings[row].set_columns([0], noise_dists[i:i+1], noise_counts[i:i+1])
+
+        # inter-chip distances are stored for each chip as a run of (other 
+        # chip, distance history) pairs, the end of each run in inter_chip_ends
+        row_map = numpy.array([self.chipIndex.get(name, -1) for name in all_names], int)
+        inter_ends = arrays['inter_chip_ends'].tolist()
+        others = row_map[arrays['inter_chip_others']]
+        inter_counts = arrays['inter_chip_counts']
+        inter_dists = arrays['inter_chip_dists']
+        for i in numpy.flatnonzero(arrays['inter_chip_flags']).tolist():
+            start = inter_ends[i-1] if i > 0 else 0
+            end = inter_ends[i]
+            known = others[start:end] >= 0
+            row = rows[i]
+            if self.interChipDistRings[row] is None:
+                self.interChipDistRings[row] = self.new_inter_chip_ring()
+            ring = self.interChipDistRings[row]
+            ring.set_columns(others[start:end][known], inter_dists[start:end][known], inter_counts[start:end][known])
+        del arrays, sigs
+        return header.get('journal_seq', 0), rows
+
+    def save_binary(self, fileName):
+        """Save data to a binary database file, see write_arrays"""
+        self.binary_writer(fileName)()
+
+    def binary_writer(self, fileName, rows=None):
+        """Returns a function which writes the data of the chips with ids
+        rows, or of all chips, as it is now, to a binary database file"""
+        rows = numpy.arange(len(self.chipNames)) if rows is None else numpy.array(rows, int)
+        num = len(rows)
+        depth = self.max_num_dists
+        arrays = [('rows', rows.astype(numpy.int32))] + name_arrays(self.chipNames) + [
+            ('meas_count', self.measCounts[rows]),
+            ('sigs', self.sigMatrix[rows]),
+            ('unstable_flags', self.unstableFlags[rows].astype(numpy.uint8)),
+            ('flip_counts', self.flipCounts[rows]),
+            ]
+
+        noise_counts = -numpy.ones(num, numpy.int32)
+        noise_dists = numpy.zeros((num, depth), self.distType)
+        inter_flags = numpy.zeros(num, numpy.uint8)
+        inter_lengths = numpy.zeros(num, numpy.int64)
+        others, counts, dists = [], [], []
+        for i, row in enumerate(rows.tolist()):
+            if self.noiseDistRings[row] is not None:
+                column_dists, column_counts = self.noiseDistRings[row].get_columns([0])
+                noise_dists[i] = column_dists[0]
+                noise_counts[i] = column_counts[0]
+            if self.interChipDistRings[row] is not None:
+                ring = self.interChipDistRings[row]
+                columns = ring.columns()
+                column_dists, column_counts = ring.get_columns(columns)
+                inter_flags[i] = 1
+                inter_lengths[i] = len(columns)
+                others.append(columns.astype(numpy.int32))
+                counts.append(column_counts)
+                dists.append(column_dists)
+        arrays += [
+            ('noise_counts', noise_counts),
+            ('noise_dists', noise_dists),
+            ('inter_chip_flags', inter_flags),
+            ('inter_chip_ends', numpy.cumsum(inter_lengths)),
+            ('inter_chip_others', numpy.concatenate(others) if others else numpy.zeros(0, numpy.int32)),
+            ('inter_chip_counts', numpy.concatenate(counts) if counts else numpy.zeros(0, numpy.int32)),
+            ('inter_chip_dists', numpy.concatenate(dists) if dists else numpy.zeros((0, depth), self.distType)),
+            ]
+        header = {'nb':self.nb, 'max_num_dists':depth, 'journal_seq':self.journalSeq}
+
+        def write():
+            print 'Saving %d chips to \'%s\'' % (num, fileName)
+            write_arrays(fileName, header, arrays)
+        return write
+
+    def export_sigs(self, fileName):
+        """Write the names and packed signatures of the chips alone to a 
+        binary file, which any number of other processes can then map
+        read-only with open_sigs, sharing one copy of it"""
+        with self.lock:
+            num = len(self.chipNames)
+            arrays = [('rows', numpy.arange(num, dtype=numpy.int32))] + name_arrays(self.chipNames) + [
+                ('sigs', self.sigMatrix[:num].copy())]
+        write_arrays(fileName, {'nb':self.nb}, arrays)
+
+    def load_sqlite(self, fileName):
+        """Open an SQLite database. Only the chip names, measurement counts, 
+        packed signatures, flip counts and distance histograms are read
+        now, the distances of each chip are read the first time they are used."""
+        self.store = SQLiteStore(fileName)
+        nb = self.store.get_meta('nb', self.nb)
+        if nb != self.nb:
+            raise NameError('Database holds %d-bit signatures, expecting %d' % (nb, self.nb))
+        ids, names, meas_counts, has_noise, has_inter_chip = self.store.read_chips()
+        if ids != range(len(ids)):
+            raise NameError('Chip ids in \'%s\' must run from 0 without gaps' % fileName)
+
+        names = [decode_name(name) for name in names]
+        self.chipNames = names
+        self.chipIndex = dict((name, row) for row, name in enumerate(names))
+        self.reserve(len(names))
+        self.measCounts[:len(names)] = meas_counts
+        self.sigMatrix[:len(names)] = self.store.read_signatures(numpy.uint64).reshape(len(names), self.nw)
+        if self.index is not None:
+            self.index.add_many(numpy.arange(len(names)), self.sigMatrix[:len(names)])
+        # older databases have no flip counts, count one flip per unstable bit
+        unstable_ids, unstable = self.store.read_unstable_bits(numpy.uint64)
+        self.flipCounts[unstable_ids] = self.unpack_flips(unstable.reshape(len(unstable_ids), self.nw))
+        self.unstableFlags[unstable_ids] = True
+        flip_ids, flips = self.store.read_flip_counts(numpy.uint16)
+        self.flipCounts[flip_ids] = flips.reshape(len(flip_ids), self.nb)
+        self.unstableFlags[flip_ids] = True
+
+        self.noiseDistRings = PagedList(len(names), [row for row, flag in enumerate(has_noise) if flag], self.page_noise_ring)
+        self.interChipDistRings = PagedList(len(names), [row for row, flag in enumerate(has_inter_chip) if flag], self.page_inter_chip_ring)
+        for hist, kind in [(self.noiseDistHist, 'noise'), (self.interChipDistHist, 'inter_chip')]:
+            counts = self.store.read_hist(kind, numpy.int64)
+            if counts is not None:
+                hist[:] = counts
+
+    def page_noise_ring(self, row):
+        others, dists = self.store.read_dists(row, self.distType, [row])
+        return self.paged_ring(self.new_noise_ring(), [0] if others else [], dists)
+
+    def page_inter_chip_ring(self, row):
+        others, dists = self.store.read_dists(row, self.distType)
+        return self.paged_ring(self.new_inter_chip_ring(), others, dists)
+
+    def paged_ring(self, ring, columns, dists):
+        """Fill a new ring with samples read from the store. These are 
+        already counted in the stored histograms."""
+        hist, ring.hist = ring.hist, None
+        counts = [len(column) for column in dists]
+        matrix = numpy.zeros((len(dists), max([0] + counts)), self.distType)
+        for row, column in enumerate(dists):
+            matrix[row, :len(column)] = column
+        ring.set_columns(columns, matrix, counts)
+        ring.hist = hist
+        return ring
+
+    def sqlite_writer(self, fileName):
+        """Returns a function which writes the chips changed since the last
+        write, as they are now, to the SQLite database, or all of the chips
+        to a new one"""
+        reset = self.store is None or self.store.fileName != fileName
+        if reset:
+            # the paged data is read from the database being replaced
+            for paged in [self.noiseDistRings, self.interChipDistRings]:
+                if isinstance(paged, PagedList):
+                    paged.page_in()
+            self.close_store()
+            self.store = SQLiteStore(fileName)
+        rows = range(len(self.chipNames)) if reset else sorted(self.dirty)
+        records = []
+        for row in rows:
+            noise = self.noiseDistRings[row]
+            inter = self.interChipDistRings[row]
+            others, dists, counts = [], [], []
+            if noise is not None:
+                column_dists, column_counts = noise.get_columns([0])
+                others.append([row])
+                dists.append(column_dists)
+                counts.append(column_counts)
+            if inter is not None:
+                column_dists, column_counts = inter.get_columns(inter.columns())
+                others.append(inter.columns())
+                dists.append(column_dists)
+                counts.append(column_counts)
+            records.append((row, self.chipNames[row], int(self.measCounts[row]),
+                noise is not None, inter is not None, self.sigMatrix[row].copy(),
+                self.flipCounts[row].copy() if self.unstableFlags[row] else None,
+                [other for column in others for other in column],
+                [dist for column in dists for dist in column],
+                [count for column in counts for count in column]))
+        hists = {'noise':self.noiseDistHist.copy(), 'inter_chip':self.interChipDistHist.copy()}
+        store = self.store
+        meta = {'nb':self.nb}
+
+        def write():
+            if reset:
+                print 'Saving chip signature database to \'%s\'' % fileName
+            store.write_chips(records, hists, meta, reset)
+        return write
+
+    def Identify(self, bits, radius=None, limit=None):
+        """This compares a bit string against all known chip signatures and returns the closest match.
+        If the index is enabled and a radius (relative distance) is given, only the chips which the 
+        index finds within that radius are compared. The whole database is searched when no chip 
+        is found within the radius, and the limit if there is one.
+        The search is bounded by the best distance found so far and, if given, by a limit 
+        (relative distance). (None, None) is returned if no chip is within the limit."""
+
+        words = bitstringutils.pack_words(bits, self.nw)
+        if self.index is not None and radius is not None:
+            rows = self.index.candidates(words, int(radius*self.nb))
+            if rows is not None and len(rows) > 0:
+                dists = bitstringutils.hd_one_to_many(words, self.sigMatrix[rows])
+                best = int(dists.argmin())
+                if dists[best] <= (radius if limit is None else min(radius, limit))*self.nb:
+                    return self.chipNames[rows[best]], float(dists[best])/self.nb
+
+        if self.pool is not None:
+            rows, dists = self.pool.top_k(words, 1, len(self.chipNames))
+            if rows.shape[1] == 0 or (limit is not None and dists[0, 0] > int(limit*self.nb)):
+                return None, None
+            row, dist = int(rows[0, 0]), int(dists[0, 0])
+        else:
+            row, dist = self.bounded_nearest(words, self.nb if limit is None else int(limit*self.nb))
+            if row is None:
+                return None, None
+        return self.chipNames[row], float(dist)/self.nb
+
+    def bounded_nearest(self, words, limit):
+        """Returns (row, distance) of the signature closest to the packed words, 
+        considering only distances no more than limit bits, else (None, None).
+        Distances are accumulated one word at a time and a chip is dropped as 
+        soon as its partial distance exceeds the bound. The bound tightens to 
+        the full distance of the most promising chip after each word, so 
+        unrelated chips at ~50% distance are usually dropped after one word.
+        With fewer than min_bounded_rows chips, scanning them all is faster."""
+        if len(self.chipNames) < self.min_bounded_rows:
+            dists = bitstringutils.hd_one_to_many(words, self.sigMatrix[:len(self.chipNames)])
+            if len(dists) == 0 or dists.min() > limit:
+                return None, None
+            best = int(dists.argmin())
+            return best, int(dists[best])
+        rows = numpy.arange(len(self.chipNames))
+        partial = numpy.zeros(len(rows), numpy.int64)
+        bound = limit
+        for i in range(self.nw):
+            partial += bitstringutils.popcount((self.sigMatrix[rows, i] ^ words[i])[:, numpy.newaxis])
+            keep = partial <= bound
+            rows, partial = rows[keep], partial[keep]
+            if len(rows) == 0:
+                return None, None
+            best = rows[partial.argmin()]
+            bound = min(bound, bitstringutils.popcount(self.sigMatrix[best] ^ words))
+        best = int(partial.argmin())
+        return int(rows[best]), int(partial[best])
     
     def MatchMap(self, bits):
         "This compares a bit string against all known chip signatures"
 
-        hd_dict = dict()
-        for key, value in self.signatureMap.items():
-            relhd = float(bitstringutils.hd(bits, value))/self.nb
-            hd_dict[key] = relhd
+        relhds = self.distances(bits).astype(float)/self.nb
+        return dict(zip(self.chipNames, relhds.tolist()))
+
+    def top_k(self, bits, k):
+        """Returns a list of the (name, relative distance) tuples of the k 
+        chips closest to a bit string, closest first"""
+
+        rows, dists = self.top_k_batch(bitstringutils.pack_words(bits, self.nw), k)
+        return [(self.chipNames[row], float(dist)/self.nb) for row, dist in zip(rows[0], dists[0])]
+
+    def top_k_batch(self, sigs, k):
+        """For each row of a matrix of packed signatures, the ids of the k 
+        chips closest to it and their Hamming distances, as two matrices, 
+        closest first. Chips at the same distance are ordered by id. The 
+        search is split across the pool, if there is one."""
+        sigs = numpy.asarray(sigs, numpy.uint64).reshape(-1, self.nw)
+        if self.pool is not None:
+            return self.pool.top_k(sigs, k, len(self.chipNames))
+        return signaturepool.top_k(self.sigMatrix[:len(self.chipNames)], sigs, k)
+
+    def distances(self, bits):
+        """Returns an array of Hamming distances from a bit string to the 
+        signature of each chip, in the order of chipNames"""
+        words = bitstringutils.pack_words(bits, self.nw)
+        return bitstringutils.hd_one_to_many(words, self.sigMatrix[:len(self.chipNames)])
 
-        return hd_dict
+    def set_sig(self, chip_name, sig):
+        """Store the signature of a chip, packing it into the signature matrix.
+        A new chip is given the next id. Returns the id of the chip."""
+        row = self.chipIndex.get(chip_name)
+        if row is None:
+            row = len(self.chipNames)
+            self.reserve(row + 1)
+            self.chipIndex[chip_name] = row
+            self.chipNames.append(chip_name)
+            self.noiseDistRings.append(None)
+            self.interChipDistRings.append(None)
+        elif self.index is not None:
+            self.index.remove(row, self.sigMatrix[row])
+        self.sigMatrix[row] = bitstringutils.pack_words(sig, self.nw)
+        if self.index is not None:
+            self.index.add(row, self.sigMatrix[row])
+        return row
 
-    def add(self, chip_name, sig):
+    def unpack(self, words):
+        """The bit string packed into a row of words"""
+        return Bits(bytes=words.tostring()[:(self.nb+7)//8], length=self.nb)
+
+    def add(self, chip_name, sig, journal=True):
+        """Enrol a chip, returns its id"""
         # I can store more than one <sig> per <chip> in the XML and do averaging, 
         # but since I'm using the minimum Hamming distance, there's no problem with 
         # just storing the first measured signature here
-        self.signatureMap[chip_name] = sig
-        self.measCount[chip_name] = 0
+        with self.lock:
+            row = self.set_sig(chip_name, sig)
+            self.measCounts[row] = 0
+            if journal:
+                self.journal('E', row, sig)
+            return row
 
     def get_sig(self, chip_name):
-        return self.signatureMap[chip_name]
+        return self.unpack(self.sigMatrix[self.chipIndex[chip_name]])
+
+    def get_unstable_bits(self, chip_name):
+        return self.unstable_bits(self.flipCounts[self.chipIndex[chip_name]])
+
+    def get_flip_counts(self, chip_name):
+        """Array of the number of measurements in which each bit of a chip
+        differed from its enrolled signature"""
+        return self.flipCounts[self.chipIndex[chip_name]]
+
+    def get_bit_error_rates(self, chip_name):
+        """Array of the fraction of measurements, after the first since
+        enrolment, in which each bit of a chip flipped"""
+        row = self.chipIndex[chip_name]
+        return self.flipCounts[row] / float(max(1, self.measCounts[row] - 1))
+
+    def unstable_bits(self, flips):
+        """The bit string of the bits which have flipped at least once"""
+        return Bits(bytes=numpy.packbits(flips > 0).tostring(), length=self.nb)
 
-    def process_sig (self, chip_name, sig):
+    def unpack_flips(self, words):
+        """Flip counts of one for each bit set in rows of packed words"""
+        words = numpy.ascontiguousarray(words, numpy.uint64)
+        return numpy.unpackbits(words.view(numpy.uint8), axis=-1)[...,:self.nb]
+
+    def new_noise_ring(self):
+        return DistRing(self.max_num_dists, 1, self.distType, self.noiseDistHist)
+
+    def new_inter_chip_ring(self):
+        return DistRing(self.max_num_dists, len(self.chipNames), self.distType, self.interChipDistHist)
+
+    def process_sig (self, chip_name, sig, journal=True):
         """This computes and records some greedy statistics on a given signature"""
+        with self.lock:
+            words = bitstringutils.pack_words(sig, self.nw)
+            row = self.chipIndex.get(chip_name)
+            # add this chip if it is unknown, replaying the measurement does this too
+            if row is None:
+                row = self.add(chip_name, sig, journal=False)
+            else:
+                # count the bits which flipped
+                self.unstableFlags[row] = True
+                if self.measCounts[row] > 0:
+                    flips = self.unpack_flips(self.sigMatrix[row] ^ words)
+                    self.flipCounts[row] += flips & (self.flipCounts[row] < 0xffff)
 
-        # add this chip if it is unknown
-        if chip_name not in self.signatureMap.keys():
-            self.add(chip_name, sig)
-        else:
-            # update unstable bit map
-            if chip_name not in self.unstableBits:
-                self.unstableBits[chip_name] = BitStream(uint=0, length=self.nb)
-            if self.measCount[chip_name] > 0:
-                self.unstableBits[chip_name] = self.unstableBits[chip_name] | (self.signatureMap[chip_name] ^ sig) 
-        
-        # Increment the measurement count for this chip
-        self.measCount[chip_name] += 1
-
-        # record 1 noise distance
-        if chip_name not in self.noiseDistMap.keys():
-            self.noiseDistMap[chip_name] = []
-        else: 
-            # assume that if we didn't have a list, that this is the first measurement, 
-            # and therefore we need to wait for a subsequent one before we can compute a noise distance
-            self.noiseDistMap[chip_name].append(bitstringutils.hd(sig, self.signatureMap[chip_name]))
-            # for scalability, should truncate this list 
-            if len(self.noiseDistMap[chip_name]) > self.max_num_dists:
-                self.noiseDistMap[chip_name] = self.noiseDistMap[chip_name][-self.max_num_dists:]
-
-        # and record (N_C - 1) inter-chip distances
-        for other_chip_name in self.signatureMap.keys():
-            if other_chip_name == chip_name:
-                # don't compare to self 
-                continue
-            if chip_name not in self.interChipDistMap.keys():
-                self.interChipDistMap[chip_name] = dict()
-            if other_chip_name not in self.interChipDistMap[chip_name].keys():
-                self.interChipDistMap[chip_name][other_chip_name] = []
-            self.interChipDistMap[chip_name][other_chip_name].append(
-                bitstringutils.hd(sig, self.signatureMap[other_chip_name]))
-            # for scalability, I truncate this list 
-            if len(self.interChipDistMap[chip_name][other_chip_name]) > self.max_num_dists:
-                self.interChipDistMap[chip_name][other_chip_name] = self.interChipDistMap[chip_name][other_chip_name][-self.max_num_dists:]
+            # Increment the measurement count for this chip
+            self.measCounts[row] += 1
+            self.version += 1
+
+            # compare against every enrolled signature in one pass
+            dists = bitstringutils.hd_one_to_many(words, self.sigMatrix[:len(self.chipNames)])
+
+            # record 1 noise distance
+            if self.noiseDistRings[row] is None:
+                self.noiseDistRings[row] = self.new_noise_ring()
+            else: 
+                # assume that if we didn't have a history, that this is the first measurement, 
+                # and therefore we need to wait for a subsequent one before we can compute a noise distance
+                self.noiseDistRings[row].append(dists[row:row+1])
+
+            # and record (N_C - 1) inter-chip distances, but don't compare to self
+            if len(self.chipNames) > 1:
+                if self.interChipDistRings[row] is None:
+                    self.interChipDistRings[row] = self.new_inter_chip_ring()
+                self.interChipDistRings[row].append(dists, skip=row)
+
+            if journal:
+                self.journal('M', row, sig)
+
+    def process_batch(self, chip_names, sigs, journal=True):
+        """Process a batch of measurements, with the same results as calling
+        process_sig on each in turn. The signatures are packed into the rows
+        of a matrix of words, as by bitstringutils.pack_words. Measurements
+        are taken a chip at a time, and the distances computed only for the
+        last max_num_dists of each chip, since no more can be held."""
+        with self.lock:
+            sigs = numpy.asarray(sigs, numpy.uint64).reshape(len(chip_names), self.nw)
+            num_chips = len(self.chipNames)
+            rows = numpy.zeros(len(chip_names), int)
+            for i, chip_name in enumerate(chip_names):
+                row = self.chipIndex.get(chip_name)
+                rows[i] = self.add(chip_name, self.unpack(sigs[i]), journal=False) if row is None else row
+            if not len(rows):
+                return
+            # the number of chips enrolled as of each measurement
+            widths = numpy.maximum(numpy.maximum.accumulate(rows) + 1, num_chips)
+            self.version += len(rows)
+
+            # the measurements of each chip, in order
+            order = numpy.argsort(rows, kind='mergesort')
+            for measured in numpy.split(order, numpy.flatnonzero(numpy.diff(rows[order])) + 1):
+                row = rows[measured[0]]
+                enrolled = row >= num_chips
+                diffs = self.sigMatrix[row] ^ sigs[measured]
+
+                # count the bits which flipped, in every measurement but the
+                # first since enrolment
+                if not enrolled or len(measured) > 1:
+                    self.unstableFlags[row] = True
+                first = 0 if self.measCounts[row] > 0 else 1
+                if len(measured) > first:
+                    flips = self.unpack_flips(diffs[first:]).sum(axis=0) + self.flipCounts[row]
+                    self.flipCounts[row] = numpy.minimum(flips, 0xffff)
+                self.measCounts[row] += len(measured)
+
+                # record noise distances, but not on the first measurement
+                noise = bitstringutils.popcount(diffs)
+                if self.noiseDistRings[row] is None:
+                    self.noiseDistRings[row] = self.new_noise_ring()
+                    noise = noise[1:]
+                noise = noise[-self.max_num_dists:, numpy.newaxis]
+                self.noiseDistRings[row].extend(noise, numpy.ones(len(noise), int))
+
+                # and inter-chip distances, once there are other chips
+                measured = measured[widths[measured] > 1][-self.max_num_dists:]
+                if len(measured):
+                    if self.interChipDistRings[row] is None:
+                        self.interChipDistRings[row] = self.new_inter_chip_ring()
+                    dists = self.distance_matrix(sigs[measured], widths[measured[-1]])
+                    self.interChipDistRings[row].extend(dists, widths[measured], skip=row)
+
+            if journal:
+                self.journal_many('M', rows.tolist(), [self.unpack(sig) for sig in sigs])
+
+    def distance_matrix(self, sigs, width):
+        """Hamming distances from each of the rows of packed signatures to
+        the signatures of the first width chips"""
+        return bitstringutils.hd_matrix(sigs, self.sigMatrix[:width])
 
     def get_meas_count(self, chip_name):
-        if chip_name in self.measCount:
-            return self.measCount[chip_name]
-        else:
-            return 0
+        row = self.chipIndex.get(chip_name)
+        return 0 if row is None else int(self.measCounts[row])
 
     def get_num_unstable_bits (self, chip_name):
-        return self.unstableBits[chip_name].count(1)
+        return int(numpy.count_nonzero(self.flipCounts[self.chipIndex[chip_name]]))
 
     def unstable_bits_valid (self, chip_name):
-        return self.measCount[chip_name] > 1
+        return self.measCounts[self.chipIndex[chip_name]] > 1
+
+    def has_noise_dists (self, chip_name):
+        row = self.chipIndex.get(chip_name)
+        return row is not None and self.noiseDistRings[row] is not None
+
+    def has_inter_chip_dists (self, chip_name):
+        row = self.chipIndex.get(chip_name)
+        return row is not None and self.interChipDistRings[row] is not None
 
     def get_noise_dist_avg (self, chip_name):
-        return float(sum(self.noiseDistMap[chip_name]))/max(1,len(self.noiseDistMap[chip_name]))
+        return self.noiseDistRings[self.chipIndex[chip_name]].mean()
+
+    def get_noise_dist_var (self, chip_name):
+        return self.noiseDistRings[self.chipIndex[chip_name]].var()
 
     def get_inter_dist_avg (self, chip_name):
-        inter_dists = [sum(inter_dist_list) for inter_dist_list in self.interChipDistMap[chip_name].values()]
-        num_dists = [len(inter_dist_list) for inter_dist_list in self.interChipDistMap[chip_name].values()]
-        return float(sum(inter_dists))/max(1, sum(num_dists))
+        return self.interChipDistRings[self.chipIndex[chip_name]].mean()
+
+    def get_inter_dist_var (self, chip_name):
+        return self.interChipDistRings[self.chipIndex[chip_name]].var()
+
+    def get_noise_dist_hist (self):
+        """Counts of each noise distance 0..nb held for all chips"""
+        return self.noiseDistHist
+
+    def get_inter_chip_dist_hist (self):
+        """Counts of each inter-chip distance 0..nb held for all chips"""
+        return self.interChipDistHist
 
     def get_all_noise_dists (self):
-        all_noise_dists = []
-        for chip_name, noise_dists in self.noiseDistMap.items():
-            all_noise_dists.extend(noise_dists)
-        return all_noise_dists
+        """Array of all noise distances held, in ascending order"""
+        return numpy.repeat(numpy.arange(self.nb+1), self.noiseDistHist)
 
     def get_all_inter_chip_dists (self):
-        all_inter_chip_dists = []
-        for this_chip_name, dist_map in self.interChipDistMap.items():
-            for other_chip_name, inter_chip_dists in dist_map.items():
-                all_inter_chip_dists.extend(inter_chip_dists)
-        return all_inter_chip_dists
+        """Array of all inter-chip distances held, in ascending order"""
+        return numpy.repeat(numpy.arange(self.nb+1), self.interChipDistHist)
+
+    def fit_alias(self):
+        """Fit gamma distributions to the noise and inter-chip distances, 
+        starting from the previous fit if there is one"""
 
-    def prob_alias(self, plot=False):
-        """Returns tuple (threshold, probability)"""
+        if self.aliasFit is None:
+            nd_params = gamma_fit_hist(self.noiseDistHist)
+            icd_params = gamma_fit_hist(self.interChipDistHist)
+        else:
+            # warm start, the distributions change little between measurements
+            version, nd_params, icd_params = self.aliasFit
+            nd_params = gamma_fit_hist(self.noiseDistHist, nd_params)
+            icd_params = gamma_fit_hist(self.interChipDistHist, icd_params)
+        self.aliasFit = (self.version, nd_params, icd_params)
+
+    def alias_gamma(self):
+        """Fit gamma distributions to the distances by maximum likelihood, 
+        again once every alias_refit_interval measurements"""
 
         from scipy.stats import gamma
-        # scipy-ref.pdf Section 5.13 on page 390
         
+        if self.aliasFit is None or self.version - self.aliasFit[0] >= self.alias_refit_interval:
+            self.fit_alias()
+        version, nd_params, icd_params = self.aliasFit
+        ndrv = gamma(*nd_params)
+        icdrv = gamma(*icd_params)
+        threshold = ndrv.ppf(self.noise_quantile)
+        return threshold, icdrv.cdf(threshold), ndrv.pdf, icdrv.pdf
+
+    def alias_empirical(self):
+        """Take the quantile and the CDF directly from the distance histograms"""
+
+        nd_cdf = self.noiseDistHist.cumsum()
+        threshold = int(numpy.searchsorted(nd_cdf, self.noise_quantile * nd_cdf[-1]))
+        icd_cdf = self.interChipDistHist.cumsum()
+        return threshold, float(icd_cdf[threshold]) / icd_cdf[-1], None, None
+
+    def alias_normal(self):
+        """Fit normal distributions to the distances by the method of moments"""
+
+        nd_mu, nd_sd = hist_moments(self.noiseDistHist)
+        icd_mu, icd_sd = hist_moments(self.interChipDistHist)
+        threshold = nd_mu + nd_sd * norm_ppf(self.noise_quantile)
+        prob = 0.5 * math.erfc((icd_mu - threshold) / (icd_sd * math.sqrt(2)))
+        return threshold, prob, norm_pdf(nd_mu, nd_sd), norm_pdf(icd_mu, icd_sd)
+
+    def alias_binomial(self):
+        """Fit binomial distributions to the distances by the method of moments, 
+        as if every bit flipped independently with the same probability"""
+
+        nd_pmf = binom_pmf(self.nb, hist_moments(self.noiseDistHist)[0] / self.nb)
+        icd_pmf = binom_pmf(self.nb, hist_moments(self.interChipDistHist)[0] / self.nb)
+        threshold = int(numpy.searchsorted(nd_pmf.cumsum(), self.noise_quantile))
+        return threshold, min(1.0, icd_pmf[:threshold+1].sum()), \
+                lambda x: nd_pmf[numpy.asarray(x, int)], lambda x: icd_pmf[numpy.asarray(x, int)]
+
+    alias_estimators = {
+            'gamma' : alias_gamma,
+            'empirical' : alias_empirical,
+            'normal' : alias_normal,
+            'binomial' : alias_binomial,
+            }
+
+    def prob_alias(self, plot=False, estimator=None):
+        """Returns tuple (threshold, probability). The threshold bounds the 
+        noise_quantile fraction of noise distances, and the probability is that 
+        of an inter-chip distance falling within it. The estimator is named by 
+        one of the keys of alias_estimators, by default alias_estimator."""
+
+        if estimator is None:
+            estimator = self.alias_estimator
+        threshold, prob, nd_pdf, icd_pdf = self.alias_estimators[estimator](self)
+
         if plot:
             import matplotlib.pyplot as plt
             plt.ion()
             plt.clf()
+            for hist, pdf in ((self.noiseDistHist, nd_pdf), (self.interChipDistHist, icd_pdf)):
+                x = numpy.flatnonzero(hist)
+                plt.hist(x, weights=hist[x], normed=True) # 'normed' might become 'density' later? 
+                if pdf is not None:
+                    x = range(x.max())
+                    plt.plot(x, pdf(x))
+            plt.axvline(threshold)
 
-        nd = self.get_all_noise_dists()
-        a, loc, scale = gamma.fit(nd)
-        ndrv = gamma(a, loc, scale)
-        if plot:
-            plt.hist(nd, normed=True) # 'normed' might become 'density' later? 
-            x = range(max(nd))
-            plt.plot(x, ndrv.pdf(x))
+        print 'Noise %.1f%% threshold: %f, probability of aliasing: %1.3e' % (100*self.noise_quantile, threshold, prob)
+        return threshold, prob
 
-        icd = self.get_all_inter_chip_dists()
-        a, loc, scale = gamma.fit(icd)
-        icdrv = gamma(a, loc, scale)
-        if plot:
-            plt.hist(icd, normed=True)
-            x = range(max(icd))
-            plt.plot(x, icdrv.pdf(x))
+class AutoSaver(threading.Thread):
+    """Saves the changes to a database from a background thread, once every 
+    count changes or interval seconds, whichever comes first, so that the 
+    thread processing measurements never waits for the whole database to be 
+    written. Only journal records are written by that thread."""
 
-        # Here it goes!
-        threshold = ndrv.ppf(0.997)
-        if plot:
-            plt.axvline(threshold)
-        prob = icdrv.cdf(threshold)
-        print 'Noise 99.7%% threshold: %f, probability of aliasing: %1.3e' % (threshold, prob)
-        return threshold, prob
+    def __init__(self, chipIdentify, count=64, interval=30.0):
+        threading.Thread.__init__(self, name='AutoSaver')
+        self.daemon = True
+        self.chipIdentify = chipIdentify
+        self.count = count
+        self.interval = interval
+        self.compact = False
+        self.running = True
+        self.wake = threading.Event()
+
+    def notify(self, compact=False):
+        """Called, holding the lock, on each change. If compact is set, the 
+        whole database is saved next."""
+        self.compact = self.compact or compact
+        if self.chipIdentify.numPending >= self.count or self.compact:
+            self.wake.set()
+
+    def run(self):
+        while self.running:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            with self.chipIdentify.lock:
+                pending = self.chipIdentify.numPending > 0 or self.compact
+                compact, self.compact = self.compact, False
+            if pending:
+                try:
+                    self.chipIdentify.save(changesOnly=not compact)
+                except (IOError, OSError) as e:
+                    print "WARNING: Autosave failed, %s" % e
+
+    def stop(self):
+        """Stop the thread, once any save in progress is finished"""
+        self.running = False
+        self.wake.set()
+        self.join()
+
+def db_format(fileName):
+    """The format of a database file, by its extension: 'xml', 'sqlite' 
+    or else 'binary'"""
+    extension = os.path.splitext(fileName)[1].lower()
+    if extension == '.xml':
+        return 'xml'
+    elif extension in ('.sqlite', '.db'):
+        return 'sqlite'
+    return 'binary'
+
+DB_MAGIC = 'SPATDB1\n'
+DB_ALIGN = 64
+JOURNAL_HEADER = '<QcHIi' # sequence number, record kind, name length, signature length in bits, CRC
+
+def journal_crc(seq, kind, name_len, sig_len, payload):
+    return zlib.crc32(kind + payload, zlib.crc32(struct.pack('<QHI', seq, name_len, sig_len)))
+
+def journal_record(seq, kind, chip_name, sig):
+    """A journal record, see ChipIdentify.journal"""
+    name = encode_name(chip_name)
+    payload = name + sig.tobytes()
+    return struct.pack(JOURNAL_HEADER, seq, kind, len(name), sig.len, 
+        journal_crc(seq, kind, len(name), sig.len, payload)) + payload
+
+def write_file(fileName, data):
+    """Replace a file with data, all at once: the data is written to a new 
+    file which is then renamed over the old"""
+    tmpfile = open(fileName + '.tmp', 'wb')
+    tmpfile.write(data)
+    tmpfile.close()
+    replace_file(fileName + '.tmp', fileName)
+
+def replace_file(source, destination):
+    if os.name == 'nt' and os.path.isfile(destination):
+        # can't rename over an existing file on Windows
+        os.remove(destination)
+    os.rename(source, destination)
+
+def write_arrays(fileName, header, arrays):
+    """Write a binary database file. It begins with a magic string and the 
+    length of a JSON header, followed by the header, which records the byte 
+    offset, type and shape of each array, then the raw arrays themselves, 
+    each aligned to DB_ALIGN bytes so that they can be mapped in place. 
+    The file is replaced all at once, as by write_file."""
+    header = dict(header, arrays=[])
+    offset = 0
+    for name, array in arrays:
+        header['arrays'].append((name, array.dtype.str, array.shape, offset))
+        offset = db_align(offset + array.nbytes)
+    header = json.dumps(header)
+    start = db_align(len(DB_MAGIC) + 4 + len(header))
+    dbfile = open(fileName + '.tmp', 'wb')
+    dbfile.write(DB_MAGIC + struct.pack('<I', len(header)) + header)
+    dbfile.write('\0' * (start - dbfile.tell()))
+    for name, array in arrays:
+        dbfile.write(numpy.ascontiguousarray(array).tostring())
+        dbfile.write('\0' * (db_align(dbfile.tell()) - dbfile.tell()))
+    dbfile.close()
+    replace_file(fileName + '.tmp', fileName)
+
+def db_align(offset):
+    return -(-offset // DB_ALIGN) * DB_ALIGN
+
+def read_header(fileName):
+    """Returns the header of a binary database file"""
+    dbfile = open(fileName, 'rb')
+    magic = dbfile.read(len(DB_MAGIC))
+    if magic != DB_MAGIC:
+        raise NameError('\'%s\' is not a signature database file' % fileName)
+    length, = struct.unpack('<I', dbfile.read(4))
+    header = json.loads(dbfile.read(length))
+    dbfile.close()
+    header['start'] = db_align(len(DB_MAGIC) + 4 + length)
+    return header
+
+def map_arrays(fileName):
+    """Returns the header of a binary database file and a dict of its arrays, 
+    mapped read-only from the file"""
+    header = read_header(fileName)
+    start = header['start']
+    arrays = dict()
+    for name, dtype, shape, offset in header['arrays']:
+        if numpy.prod(shape) == 0:
+            # an empty array can't be mapped
+            arrays[name] = numpy.zeros(shape, dtype)
+        else:
+            arrays[name] = numpy.memmap(fileName, dtype, 'r', start + offset, tuple(shape))
+    return header, arrays
+
+def open_sigs(fileName):
+    """Returns the names of the chips in a binary database file, or one 
+    written by export_sigs, and their packed signatures, as a matrix mapped
+    read-only from the file, so that it is neither read nor copied"""
+    header, arrays = map_arrays(fileName)
+    all_names = read_names(arrays)
+    return [all_names[row] for row in arrays['rows'].tolist()], arrays['sigs']
+
+def name_arrays(names):
+    """The name_ends and names arrays of a binary database file, which hold
+    chip names end to end, and the end of each"""
+    names = [encode_name(name) for name in names]
+    return [
+        ('name_ends', numpy.cumsum([len(name) for name in names], dtype=numpy.int64)),
+        ('names', numpy.frombuffer(''.join(names), numpy.uint8)),
+        ]
+
+def read_names(arrays):
+    """The chip names held in the arrays of a binary database file, see name_arrays"""
+    name_ends = arrays['name_ends'].tolist()
+    name_bytes = arrays['names'].tostring()
+    return [decode_name(name_bytes[start:end]) for start, end in zip([0] + name_ends[:-1], name_ends)]
+
+def encode_name(name):
+    """A chip name as UTF-8 bytes, for a binary file"""
+    return name.encode('utf-8') if isinstance(name, unicode) else name
+
+def decode_name(data):
+    """A chip name read from UTF-8 bytes, as a str if it is ASCII or else as
+    unicode, the same as ElementTree gives the names in an XML file, so
+    that it is the same key in chipIndex whichever file it was read from"""
+    try:
+        data.decode('ascii')
+        return data
+    except UnicodeDecodeError:
+        return data.decode('utf-8')
+
+def hist_moments(hist):
+    """Returns (mean, standard deviation) of the values counted by a histogram"""
+    values = numpy.arange(len(hist))
+    num = max(1, hist.sum())
+    mean = float((values * hist).sum()) / num
+    return mean, math.sqrt(max(0.0, float((values * values * hist).sum()) / num - mean * mean))
+
+def gamma_fit_hist(hist, params=None):
+    """Returns (shape, loc, scale) of the gamma distribution most likely to 
+    give the values counted by a histogram, the same as scipy.stats.gamma.fit 
+    of the values themselves, but in time proportional to the length of the 
+    histogram rather than the number of values. The search starts from 
+    params if given, otherwise from the method of moments."""
+
+    from scipy.optimize import fmin
+    from scipy.special import gammaln
+    # scipy-ref.pdf Section 5.13 on page 390
+
+    x = numpy.flatnonzero(hist)
+    w = hist[x].astype(float)
+    x = x.astype(float)
+    if params is None:
+        mean, sd = hist_moments(hist)
+        sd = max(sd, 1e-3)
+        skew = (w * ((x - mean) / sd) ** 3).sum() / w.sum()
+        a = 4 / (1e-8 + skew * skew)
+        scale = sd / math.sqrt(a)
+        params = (a, min(mean - a * scale, x[0] - 1e-3 * sd), scale)
+
+    def nnlf((a, loc, scale)):
+        if a <= 0 or scale <= 0 or loc >= x[0]:
+            return numpy.inf
+        y = (x - loc) / scale
+        return -(w * ((a - 1) * numpy.log(y) - y)).sum() + w.sum() * (gammaln(a) + math.log(scale))
+
+    return tuple(fmin(nnlf, params, disp=0))
+
+def norm_pdf(mu, sd):
+    return lambda x: numpy.exp(-0.5 * ((numpy.asarray(x, float) - mu) / sd) ** 2) / (sd * math.sqrt(2 * math.pi))
+
+def norm_ppf(p):
+    """Inverse of the standard normal CDF, by bisection"""
+    lo, hi = -40.0, 40.0
+    for i in range(100):
+        mid = (lo + hi) / 2
+        if 0.5 * math.erfc(-mid / math.sqrt(2)) < p:
+            lo = mid
+        else:
+            hi = mid
+    return (lo + hi) / 2
+
+def binom_pmf(n, p):
+    """Binomial probabilities of 0..n successes in n trials"""
+    k = numpy.arange(n+1)
+    p = min(max(p, 1e-12), 1 - 1e-12)
+    lgamma = numpy.vectorize(math.lgamma)
+    return numpy.exp(lgamma(n+1) - lgamma(k+1) - lgamma(n-k+1) + k*math.log(p) + (n-k)*math.log(1-p))
+
+
+if __name__ == '__main__':
+    import sys, random
+    print "Comparing estimators of the probability of aliasing"
+
+    if len(sys.argv) > 1:
+        chipIdentifier = ChipIdentify(sys.argv[1])
+    else:
+        # synthesize a sample of chips whose bits flip with varying probability
+        nb = 1024
+        numChips = 64
+        numMeas = 32
+        print "Simulating %d chips measured %d times" % (numChips, numMeas)
+        import tempfile
+        chipIdentifier = ChipIdentify(os.path.join(tempfile.mkdtemp(), 'signatures.xml'), nb)
+        names = []
+        sigs = []
+        for chip in range(numChips):
+            enrollment = numpy.random.randint(0, 2, nb).astype(bool)
+            flip_prob = numpy.random.exponential(0.01, nb)
+            for meas in range(numMeas):
+                bits = enrollment ^ (numpy.random.random_sample(nb) < flip_prob)
+                names.append('chip%03d' % chip)
+                sigs.append(Bits(bytes=numpy.packbits(bits).tostring()))
+        # measure the chips round robin, as a test station would
+        order = numpy.arange(len(names)).reshape(numChips, numMeas).T.flatten()
+        names = [names[i] for i in order]
+        sigs = [sigs[i] for i in order]
+        startTime = time.time()
+        for name, sig in zip(names, sigs):
+            chipIdentifier.process_sig(name, sig, journal=False)
+        print "process_sig: %.3f s" % (time.time() - startTime)
+
+        batchIdentifier = ChipIdentify(os.path.join(tempfile.mkdtemp(), 'signatures.xml'), nb)
+        startTime = time.time()
+        batchIdentifier.process_batch(names, numpy.array([bitstringutils.pack_words(sig) for sig in sigs]), journal=False)
+        print "process_batch: %.3f s" % (time.time() - startTime)
+        assert (batchIdentifier.noiseDistHist == chipIdentifier.noiseDistHist).all()
+        assert (batchIdentifier.interChipDistHist == chipIdentifier.interChipDistHist).all()
+        assert (batchIdentifier.flipCounts == chipIdentifier.flipCounts).all()
 
+    for estimator in sorted(chipIdentifier.alias_estimators.keys()):
+        chipIdentifier.aliasFit = None
+        startTime = time.time()
+        threshold, prob = chipIdentifier.prob_alias(estimator=estimator)
+        print "%10s: threshold %8.2f, probability %1.3e, %8.3f ms" % (estimator, threshold, prob, 1000 * (time.time() - startTime))
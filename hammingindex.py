@@ -0,0 +1,182 @@
+"""
+hammingindex.py - A multi-index hash for finding PUF signatures within
+a Hamming radius of a measurement without comparing against every
+signature in the database.
+
+Each packed signature is split into m disjoint substrings and one hash
+table is kept per substring. If two signatures are within r bits of
+each other, then by the pigeonhole principle at least one of their m
+substrings differs in no more than floor(r/m) bits. Probing each table
+with all substrings within that distance of the query yields every
+signature within the radius as a candidate. See M. Norouzi, A. Punjani
+and D. Fleet, "Fast search in Hamming space with multi-index hashing",
+in Proc. CVPR'12, pp. 3108-3115, 2012.
+
+This program features a benchmark that is executed when this file
+is executed, rather than being imported.
+"""
+
+__license__ = """
+GPL Version 3
+
+Copyright (2014) Sandia Corporation. Under the terms of Contract
+DE-AC04-94AL85000, there is a non-exclusive license for use of this
+work by or on behalf of the U.S. Government. Export of this program
+may require a license from the United States Government.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__version__ = "1.2"
+
+__author__ = "Ryan Helinski and Mitch Martin"
+
+import array, itertools
+import numpy
+
+class MultiIndexHash(object):
+    """An index of packed signatures (rows of 64-bit words) for Hamming radius queries"""
+
+    substringTypes = {8:numpy.uint8, 16:numpy.uint16, 32:numpy.uint32}
+
+    def __init__(self, nw, subBits=16, maxProbes=2 ** 14):
+        """nw is the number of 64-bit words per signature, subBits is the
+        length of each substring. If a query would need more than maxProbes
+        table lookups, the caller is told to search exhaustively instead."""
+        self.nw = nw
+        self.subBits = subBits
+        self.dtype = self.substringTypes[subBits]
+        self.m = nw * 64 // subBits
+        self.maxProbes = maxProbes
+        self.tables = [dict() for i in range(self.m)]
+        self.masks = dict()
+
+    def substrings(self, words):
+        return numpy.ascontiguousarray(words, numpy.uint64).view(self.dtype)
+
+    def add(self, row, words):
+        """Index the signature stored at row"""
+        for table, key in itertools.izip(self.tables, self.substrings(words).tolist()):
+            if key not in table:
+                table[key] = array.array('i')
+            table[key].append(row)
+
+    def add_many(self, rows, matrix):
+        """Index the signatures in the rows of matrix, stored at rows"""
+        rows = numpy.asarray(rows, numpy.int32)
+        keys = self.substrings(matrix).reshape(len(rows), self.m)
+        for i, table in enumerate(self.tables):
+            # group the rows by substring value with one sort per table
+            order = numpy.argsort(keys[:,i], kind='mergesort')
+            sortedKeys = keys[order,i]
+            bounds = numpy.flatnonzero(numpy.diff(sortedKeys)) + 1
+            starts = numpy.concatenate(([0], bounds))
+            ends = numpy.concatenate((bounds, [len(order)]))
+            for key, start, end in itertools.izip(sortedKeys[starts].tolist(), starts, ends):
+                if key not in table:
+                    table[key] = array.array('i')
+                table[key].fromstring(rows[order[start:end]].tostring())
+
+    def remove(self, row, words):
+        """Remove the signature stored at row, words must be what was indexed"""
+        for table, key in itertools.izip(self.tables, self.substrings(words).tolist()):
+            bucket = table[key]
+            del bucket[bucket.index(row)]
+            if not bucket:
+                del table[key]
+
+    def get_masks(self, subRadius):
+        """All substring values with at most subRadius bits set"""
+        if subRadius not in self.masks:
+            masks = [0]
+            for weight in range(1, subRadius+1):
+                for positions in itertools.combinations(range(self.subBits), weight):
+                    masks.append(sum(1 << p for p in positions))
+            self.masks[subRadius] = numpy.array(masks, self.dtype)
+        return self.masks[subRadius]
+
+    def num_probes(self, radius):
+        """The number of table lookups needed for a query with the given radius"""
+        subRadius = min(radius // self.m, self.subBits)
+        probes = 0
+        for weight in range(subRadius+1):
+            probes += reduce(lambda num, i: num * (self.subBits - i) // (i + 1), range(weight), 1)
+        return probes * self.m
+
+    def candidates(self, words, radius):
+        """Returns an array of the rows of every signature which may be within
+        radius bits of the query, or None if the radius is too wide to
+        probe the tables within maxProbes lookups"""
+        if self.num_probes(radius) > self.maxProbes:
+            return None
+        masks = self.get_masks(radius // self.m)
+        buckets = []
+        for table, key in itertools.izip(self.tables, self.substrings(words)):
+            for probe in (masks ^ key).tolist():
+                if probe in table:
+                    buckets.append(numpy.frombuffer(table[probe], numpy.int32))
+        if not buckets:
+            return numpy.zeros(0, numpy.int32)
+        return numpy.unique(numpy.concatenate(buckets))
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.tables[0].itervalues()) if self.m else 0
+
+
+if __name__ == '__main__':
+    import sys, time
+    import bitstringutils
+    print "Comparing multi-index hashing against exhaustive search"
+
+    nb = 1024
+    nw = bitstringutils.num_words(nb)
+    radius = nb // 32 # a few percent noise, as for a well-behaved PUF
+    numQueries = 64
+    maxExp = int(sys.argv[1]) if len(sys.argv) > 1 else 6
+
+    numpy.random.seed(0)
+    print "%10s %12s %12s %12s %10s %8s" % ('chips', 'build (s)', 'index (ms)', 'scan (ms)', 'candidates', 'speedup')
+    for exp in range(3, maxExp+1):
+        numChips = 10 ** exp
+        matrix = numpy.frombuffer(numpy.random.bytes(8 * nw * numChips), numpy.uint64).reshape(numChips, nw)
+        startTime = time.time()
+        index = MultiIndexHash(nw)
+        index.add_many(numpy.arange(numChips), matrix)
+        buildTime = time.time() - startTime
+
+        # queries are noisy re-measurements of enrolled chips
+        truth = numpy.random.randint(0, numChips, numQueries)
+        queries = matrix[truth].copy()
+        for q in range(numQueries):
+            flips = numpy.zeros(64 * nw, numpy.uint8)
+            flips[numpy.random.choice(nb, radius, replace=False)] = 1
+            queries[q] ^= numpy.packbits(flips).view(numpy.uint64)
+
+        startTime = time.time()
+        numCandidates = 0
+        for q in range(numQueries):
+            rows = index.candidates(queries[q], radius)
+            numCandidates += len(rows)
+            dists = bitstringutils.popcount(matrix[rows] ^ queries[q])
+            assert rows[dists.argmin()] == truth[q]
+        indexTime = (time.time() - startTime) / numQueries
+
+        startTime = time.time()
+        for q in range(numQueries):
+            dists = bitstringutils.popcount(matrix ^ queries[q])
+            assert dists.argmin() == truth[q]
+        scanTime = (time.time() - startTime) / numQueries
+
+        print "%10d %12.2f %12.3f %12.3f %10d %7.1fx" % (numChips, buildTime, 1000*indexTime, 1000*scanTime, numCandidates // numQueries, scanTime/indexTime)
+        del index, matrix
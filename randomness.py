@@ -35,8 +35,9 @@ __author__ = "Ryan Helinski and Mitch Martin"
 
 import bitstring
 import math # so that I can math
-from numpy import cumsum, array
+from numpy import cumsum, array, count_nonzero
 from scipy.stats import norm
+from bitstringutils import unpack_bits
 
 def entropy (bits, min=False, p_value=0.01):
     """Implements entropy and min. entropy
@@ -72,7 +73,7 @@ def runs_test (bits, p_value=0.01):
     tau = 2.0 / math.sqrt(n)
     if abs(pi - 0.5) >= tau:
         return 0, False
-    vobs = (bits[0:n-1] ^ bits[1:n]).count(1) + 1
+    vobs = num_runs(bits)
     pval = math.erfc(abs(vobs-2*n*pi*(1-pi)) / (2 * math.sqrt(2*n) * pi * (1 - pi)))
     return pval, pval >= p_value
 
@@ -81,16 +82,20 @@ def runs_test2 (bits, p_value=0.01):
     returns a tuple representing (metric, pass)"""
     n = len(bits)
     pi = .5
-    vobs = (bits[0:n-1] ^ bits[1:n]).count(1) + 1
+    vobs = num_runs(bits)
     pval = math.erfc(abs(vobs-2*n*pi*(1-pi)) / (2 * math.sqrt(2*n) * pi * (1 - pi)))
     return pval, pval >= p_value
 
+def num_runs (bits):
+    """Number of runs of identical bits"""
+    X = unpack_bits(bits)
+    return count_nonzero(X[1:] != X[:-1]) + 1
+
 def cum_sum (bits, p_value=0.01):
     """Cumulative Sums Test
     returns a tuple representing (metric, pass)"""
     n = len(bits)
-    X = array([int(bits[x]) for x in range(n)])
-    X = X * 2 - 1 
+    X = unpack_bits(bits, signs=True)
     cs = cumsum(X)
     z = max(abs(cs))
     lim_upper = int(((float(n) / z) - 1) / 4)
@@ -119,6 +124,21 @@ def randBitString(length):
     import random
     return bitstring.BitString(uint=random.getrandbits(length), length=length)
 
+# the bit strings tested by a worker process, see init_worker
+_bitStrings = None
+
+def init_worker(bitStrings):
+    """Hand a worker process the bit strings to test, once rather than with 
+    every task"""
+    global _bitStrings
+    _bitStrings = bitStrings
+
+def test_worker(argTuple):
+    """Apply a randomness function to one of the bit strings of a worker 
+    process. For use with multiprocessing.Pool"""
+    fun, index = argTuple
+    return fun(_bitStrings[index])
+
 if __name__ == '__main__':
     print "Testing Randomness functions..."
     import random, itertools
@@ -168,11 +188,11 @@ if __name__ == '__main__':
         from multiprocessing import Pool, cpu_count
 
     print "Number of bits in each string: %d, number of trials: %d" % (numBits, numTrials)
+    # The strings are made here, since forked workers would share one random
+    # state, and handed to each worker once
+    randBitStrings = map(randBitString, itertools.repeat(numBits, numTrials))
     if parallel:
-        pool = Pool(processes=cpu_count())
-        randBitStrings = pool.map(randBitString, itertools.repeat(numBits, numTrials))
-    else:
-        randBitStrings = map(randBitString, itertools.repeat(numBits, numTrials))
+        pool = Pool(cpu_count(), init_worker, (randBitStrings,))
 
     for randomness_fun in [entropy, 
                     min_entropy, 
@@ -182,7 +202,7 @@ if __name__ == '__main__':
                     cum_sum]:
 
         if parallel:
-            results = pool.map(randomness_fun, randBitStrings)
+            results = pool.map(test_worker, itertools.izip(itertools.repeat(randomness_fun), range(numTrials)))
         else:
             results = map(randomness_fun, randBitStrings)
 
@@ -0,0 +1,185 @@
+"""
+signaturepool.py - A pool of worker processes which search a matrix of
+packed PUF signatures for the closest matches to measurements. The
+matrix is held in shared memory, so it is not copied to the workers,
+and each worker searches a shard of its rows.
+"""
+
+__license__ = """
+GPL Version 3
+
+Copyright (2014) Sandia Corporation. Under the terms of Contract
+DE-AC04-94AL85000, there is a non-exclusive license for use of this
+work by or on behalf of the U.S. Government. Export of this program
+may require a license from the United States Government.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__version__ = "1.2"
+
+__author__ = "Ryan Helinski and Mitch Martin"
+
+import ctypes, multiprocessing
+from multiprocessing.sharedctypes import RawArray
+import numpy
+import bitstringutils
+
+# words of signatures compared at once, to bound the size of temporaries
+chunk_words = 2 ** 21
+
+class SignaturePool(object):
+    """Searches a matrix of signatures packed into rows of nw words with a
+    pool of processes. The matrix is allocated by the pool, in shared
+    memory, and the workers see changes to it as they are made. The
+    workers are restarted whenever a larger matrix is allocated."""
+
+    def __init__(self, nw, processes=None):
+        self.nw = nw
+        self.processes = multiprocessing.cpu_count() if processes is None else processes
+        self.pool = None
+        self.matrix = None
+
+    def allocate(self, num_rows):
+        """Returns a new matrix of num_rows signatures, all zero, which the
+        workers search from now on"""
+        self.close()
+        buf = RawArray(ctypes.c_uint64, num_rows * self.nw)
+        self.pool = multiprocessing.Pool(self.processes, init_worker, (buf, self.nw))
+        self.matrix = numpy.frombuffer(buf, numpy.uint64).reshape(num_rows, self.nw)
+        return self.matrix
+
+    def attach(self, matrix):
+        """Search a matrix mapped read-only from a file, a numpy.memmap such
+        as chipidentify.open_sigs returns, from now on. Each worker maps the
+        same file, so there is one copy of it in memory however many
+        workers there are."""
+        self.close()
+        self.pool = multiprocessing.Pool(self.processes, map_worker, (matrix.filename, matrix.offset, matrix.shape))
+        self.matrix = matrix
+        return self.matrix
+
+    def top_k(self, queries, k, num_rows):
+        """For each row of a matrix of packed queries, the rows of the k
+        signatures among the first num_rows closest to it, and their Hamming
+        distances, as two matrices, closest first. Each worker searches an
+        equal shard of the rows, and their results are merged."""
+        queries = numpy.ascontiguousarray(queries, numpy.uint64).reshape(-1, self.nw)
+        bounds = numpy.linspace(0, num_rows, self.processes + 1).astype(int)
+        tasks = [(start, stop, queries, k) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+        keys = self.pool.map(search_shard, tasks)
+        return split_keys(select_k(numpy.hstack(keys + [numpy.zeros((len(queries), 0), numpy.int64)]), k))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+def top_k(matrix, queries, k, start=0):
+    """For each row of a matrix of packed queries, the rows of the k
+    signatures in matrix closest to it, offset by start, and their Hamming
+    distances, as two matrices, closest first"""
+    return split_keys(top_k_keys(matrix, queries, k, start))
+
+def top_k_keys(matrix, queries, k, start=0):
+    """The top_k as keys, see select_k. The matrix is compared in chunks,
+    keeping the best k so far."""
+    nw = matrix.shape[1]
+    keys = numpy.zeros((len(queries), 0), numpy.int64)
+    step = max(1, chunk_words // max(1, len(queries) * nw))
+    for first in range(0, len(matrix), step):
+        chunk = matrix[first:first+step]
+        dists = bitstringutils.hd_matrix(queries, chunk).astype(numpy.int64)
+        rows = numpy.arange(start + first, start + first + len(chunk))
+        keys = select_k(numpy.hstack((keys, (dists << 32) | rows)), k)
+    return keys
+
+def select_k(keys, k):
+    """The k least of each row of a matrix of keys, in order. Each key is a
+    distance shifted left 32 bits OR'ed with a row, so that rows are ordered
+    by distance and then by row."""
+    if k < keys.shape[1]:
+        # partial selection, only the k best are sorted
+        keys = numpy.partition(keys, k-1, axis=1)[:,:k]
+    return numpy.sort(keys, axis=1)
+
+def split_keys(keys):
+    """The rows and distances in a matrix of keys, see select_k"""
+    return keys & 0xffffffff, keys >> 32
+
+# the matrix searched by a worker process, see init_worker
+_matrix = None
+
+def init_worker(buf, nw):
+    """Attach a worker process to the shared matrix"""
+    global _matrix
+    _matrix = numpy.frombuffer(buf, numpy.uint64).reshape(-1, nw)
+
+def map_worker(fileName, offset, shape):
+    """Map the matrix of a worker process from a file"""
+    global _matrix
+    _matrix = numpy.memmap(fileName, numpy.uint64, 'r', offset, tuple(shape))
+
+def search_shard(args):
+    """The top_k_keys of the rows start to stop of the shared matrix. For
+    use with multiprocessing.Pool"""
+    start, stop, queries, k = args
+    return top_k_keys(_matrix[start:stop], queries, k, start)
+
+if __name__ == '__main__':
+    import sys, time
+    print "Comparing a pool of workers against one process"
+
+    nb = 1024
+    nw = bitstringutils.num_words(nb)
+    numChips = int(sys.argv[1]) if len(sys.argv) > 1 else 2 ** 18
+    numQueries = 64
+    k = 8
+
+    numpy.random.seed(0)
+    pool = SignaturePool(nw)
+    matrix = pool.allocate(numChips)
+    matrix[:] = numpy.frombuffer(numpy.random.bytes(8 * nw * numChips), numpy.uint64).reshape(numChips, nw)
+    truth = numpy.random.randint(0, numChips, numQueries)
+    queries = matrix[truth].copy()
+    for q in range(numQueries):
+        flips = numpy.zeros(64 * nw, numpy.uint8)
+        flips[numpy.random.choice(nb, nb // 32, replace=False)] = 1
+        queries[q] ^= numpy.packbits(flips).view(numpy.uint64)
+
+    print "%d chips, %d queries, %d processes" % (numChips, numQueries, pool.processes)
+    startTime = time.time()
+    rows, dists = top_k(matrix, queries, k)
+    oneTime = time.time() - startTime
+    print "one process: %8.3f s" % oneTime
+    assert (rows[:,0] == truth).all()
+
+    startTime = time.time()
+    pool_rows, pool_dists = pool.top_k(queries, k, numChips)
+    poolTime = time.time() - startTime
+    print "pool:        %8.3f s (%.1fx)" % (poolTime, oneTime / poolTime)
+    assert (pool_rows == rows).all() and (pool_dists == dists).all()
+
+    import tempfile, os
+    fileName = os.path.join(tempfile.mkdtemp(), 'sigs.bin')
+    matrix.tofile(fileName)
+    pool.attach(numpy.memmap(fileName, numpy.uint64, 'r', 0, matrix.shape))
+    startTime = time.time()
+    pool_rows, pool_dists = pool.top_k(queries, k, numChips)
+    mapTime = time.time() - startTime
+    print "mapped pool: %8.3f s (%.1fx)" % (mapTime, oneTime / mapTime)
+    assert (pool_rows == rows).all() and (pool_dists == dists).all()
+    pool.close()
+    os.remove(fileName)
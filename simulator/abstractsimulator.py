@@ -35,6 +35,7 @@ __version__ = "1.2"
 __author__ = "Ryan Helinski and Mitch Martin"
 
 import os, bitstring, random
+import numpy
 from bitstringutils import *
 import xml.etree.ElementTree as etree
 
@@ -76,6 +77,7 @@ class AbstractSimulator(object):
                         self.realValues.append(chipRealValues)
         self.numVirtChips = len(self.realValues)
         self.numElements = len(self.realValues[0])
+        self.realArray = numpy.array(self.realValues)
 
     def generateSetup(self):
         raise NotImplemented()
@@ -114,6 +116,10 @@ class AbstractSimulator(object):
     def noise(self):
         return random.normalvariate(self.params['noise_mu'], self.params['noise_sd'])
 
+    def noises(self, num):
+        """An array of num samples of noise"""
+        return numpy.random.normal(self.params['noise_mu'], self.params['noise_sd'], num)
+
     def next(self, virtChipIndex=0):
         raise NotImplemented()
 
@@ -136,13 +142,23 @@ class AbstractSimulator(object):
         dlg.destroy()
 
 
+# the simulator of a worker process, see init_worker
+_sim = None
+
+def init_worker(sim):
+    """Hand a worker process the simulator, once rather than with every task.
+    Workers are forked with the same random state, so it is reseeded."""
+    global _sim
+    _sim = sim
+    random.seed()
+    numpy.random.seed()
+
 def NoiseWorker(argTuple):
     """Measure one of the chips multiple times. For use with multiprocessor.pool """
 
     chipIndex, iterations = argTuple
     # Instead of generating the number of iterations for each process, I could create my own iterator object and pass that in as the argument
-    mySim = AbstractSimulator()
-    mySim.setup()
+    mySim = _sim
     enrollment = mySim.next(chipIndex)
     noise_hds = [hd(enrollment, mySim.next(chipIndex)) for measIndex in range(iterations)]
     print "Chip v%03d (of %d): %d / %d = %0.3f %%" % (chipIndex+1, mySim.numVirtChips, sum(noise_hds), iterations * mySim.nb, (100 * float(sum(noise_hds)) / iterations / mySim.nb))
@@ -154,7 +170,7 @@ if __name__=="__main__":
     print "Running self-test"
     mySim = AbstractSimulator()
     mySim.setup() # setup with defaults
-    p = multiprocessing.Pool(multiprocessing.cpu_count())
+    p = multiprocessing.Pool(multiprocessing.cpu_count(), init_worker, (mySim,))
     argIter = itertools.izip(range(mySim.numVirtChips), itertools.repeat(2 ** 6))
     results = p.map(NoiseWorker, argIter)
     
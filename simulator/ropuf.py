@@ -42,9 +42,10 @@ __author__ = "Ryan Helinski and Mitch Martin"
 
 import os, random
 import bitstring
+import numpy
 from bitstringutils import *
 import xml.etree.ElementTree as etree
-from abstractsimulator import AbstractSimulator
+from abstractsimulator import AbstractSimulator, init_worker, NoiseWorker
 
 class Simulator(AbstractSimulator):
     """A PUF-simulating class. Produces simulated PUF responses."""
@@ -66,6 +67,7 @@ class Simulator(AbstractSimulator):
         self.numElements = self.nb + 1
         self.realValues = [[random.normalvariate(self.params['param_mu'], self.params['param_sd']) for index in range(self.numElements)] for chip in range(self.numVirtChips)]
         self.chipNames = [('v%03d' % (index + 1)) for index in range(self.numVirtChips)]
+        self.realArray = numpy.array(self.realValues)
 
         myxml = etree.Element('xml', attrib={'version':'1.0', 'encoding':'UTF-8'})
         myxml.text = "\n"
@@ -92,32 +94,13 @@ class Simulator(AbstractSimulator):
     def next(self, virtChipIndex=0):
         if type(virtChipIndex) == str:
             virtChipIndex = int(virtChipIndex[1:4]) - 1
-        bits = bitstring.BitArray()
-
-        noiseValues = [self.noise() for i in range(self.nb+1)]
+        values = self.realArray[virtChipIndex] + self.noises(self.nb+1)
         # This is the linear RO PUF architecture which avoids redundant 
         # bits which are inherent in the all possible combinations approach
         # i.e., comparisons a ? b and b ? c may render a ? c redundant
         # Instead, we use (NB + 1) ring oscillators and only compare adjacent 
         # oscillators (i) and (i+1) for i in (0, NB).
-        for i in range(0, self.nb):
-            lhs = self.realValues[virtChipIndex][i] + noiseValues[i]
-            rhs = self.realValues[virtChipIndex][i+1] + noiseValues[i+1]
-            bits.append(bitstring.Bits(bool=(lhs < rhs)))
-
-        return bits
-
-def NoiseWorker(argTuple):
-    """Measure one of the chips multiple times. For use with multiprocessor.pool """
-
-    chipIndex, iterations = argTuple
-    # Instead of generating the number of iterations for each process, I could create my own iterator object and pass that in as the argument
-    mySim = Simulator()
-    mySim.setup()
-    enrollment = mySim.next(chipIndex)
-    noise_hds = [hd(enrollment, mySim.next(chipIndex)) for measIndex in range(iterations)]
-    print "Chip v%03d (of %d): %d / %d = %0.3f %%" % (chipIndex+1, mySim.numVirtChips, sum(noise_hds), iterations * mySim.nb, (100 * float(sum(noise_hds)) / iterations / mySim.nb))
-    return float(sum(noise_hds)) / iterations / mySim.nb
+        return array_to_bits(numpy.packbits(values[:self.nb] < values[1:self.nb+1]), self.nb)
 
 # A self-test routine that characterizes the population statistics
 # resulting from the setup parameters
@@ -131,7 +114,7 @@ if __name__=="__main__":
     print "Running self-test"
     mySim = Simulator()
     mySim.setup() # setup with defaults
-    p = multiprocessing.Pool(multiprocessing.cpu_count())
+    p = multiprocessing.Pool(multiprocessing.cpu_count(), init_worker, (mySim,))
     argIter = itertools.izip(range(mySim.numVirtChips), itertools.repeat(2 ** 6))
     results = p.map(NoiseWorker, argIter)
     
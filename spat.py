@@ -49,12 +49,14 @@ import math
 import os
 import time
 from collections import OrderedDict
+import numpy
 
 # Local packages
 from sigfile import *
 from quartus import *
 from chipidentify import *
 import bitstring
+from bitstringutils import unpack_bits
 from simulator.ropuf import *
 import bch_code
 import randomness
@@ -72,6 +74,7 @@ class Application(Frame):
     colorMapGray = OrderedDict( [('0%', '#000000'),
                     ('50%', '#808080'),
                     ('100%', '#ffffff')] )
+    grayLevels = numpy.array(['#' + ('%02x' % level) * 3 for level in range(256)])
     sourceList = ('Simulator', 'File', 'ROPUF', 'ARBR')
     quartusSources = {
             'ROPUF' : {'tclFile' : 'measureROPUF.tcl',
@@ -115,7 +118,10 @@ class Application(Frame):
     def reset(self):
         self.measurementCounter = 0
         self.bitFlips = None
-        self.bitAvgs = [bitstring.BitArray() for x in range(self.nb)]
+        # The last maxAvgDepth signatures, one bit per column, the oldest 
+        # overwritten first
+        self.bitHistory = numpy.zeros((self.maxAvgDepth, self.nb), numpy.uint8)
+        self.numAvgs = 0
 
     def updateTitle(self, statusStr=None):
         if statusStr:
@@ -134,6 +140,8 @@ class Application(Frame):
         self.save()
 
     def quit(self, event=None):
+        if 'chipIdentifier' in self.__dict__:
+            self.chipIdentifier.stop_autosave()
         self.save()
         self.master.quit()
         self.destroy()
@@ -142,12 +150,14 @@ class Application(Frame):
         if 'chipIdentifier' in self.__dict__:
             self.chipIdentifier.save()
 
-    def mapBitImmDiff(self, index):
-        # TODO performance could be improved
-        return self.colorMapImmDiff[ str(int(self.bits[index])) + str(int(self.chipIdentifier.unstableBits[self.lastRead][index])) ]
+    def mapBitImmDiff(self):
+        "The color of each bit, by its value and whether it is unstable"
+        codes = 2 * unpack_bits(self.bits) + unpack_bits(self.lastUnstableBits)
+        return numpy.array([self.colorMapImmDiff[code] for code in ['00', '01', '10', '11']])[codes]
 
-    def mapBitGrayscale(self, index):
-        return '#' + ('%02x' % (255*float(hw(self.bitAvgs[index]))/max(1, len(self.bitAvgs[index]))) * 3)
+    def mapBitGrayscale(self):
+        "The color of each bit, by its average value"
+        return self.grayLevels[255 * self.bitHistory.sum(axis=0) // max(1, min(self.numAvgs, self.maxAvgDepth))]
 
     def destroyLegend(self):
         self.colorMapLegend.destroy()
@@ -236,8 +246,12 @@ class Application(Frame):
         self.bind_all("<Control-o>", self.loadSigFile)
         self.menuBarChipDB.add_command(label="Save", command=self.save, accelerator="Ctrl+S")
         self.bind_all("<Control-s>", self.save)
+        self.menuBarChipDB.add_command(label="Import XML", command=self.importSigFile)
+        self.menuBarChipDB.add_command(label="Export XML", command=self.exportSigFile)
         self.menuBarChipDB.add_command(label="Clear", command=self.clearSigFile, accelerator="Ctrl+N")
         self.menuBarChipDB.entryconfig('Clear', state=DISABLED)
+        self.menuBarChipDB.entryconfig('Import XML', state=DISABLED)
+        self.menuBarChipDB.entryconfig('Export XML', state=DISABLED)
         self.bind_all("<Control-n>", self.clearSigFile)
 
         self.menuBar.add_cascade(label="Chip DB", menu=self.menuBarChipDB)
@@ -259,6 +273,19 @@ class Application(Frame):
         self.probAliasEnVar = IntVar()
         self.probAliasEnVar.set(1)
         self.menuBarView.add_checkbutton(label='Prob. Alias', variable=self.probAliasEnVar)
+        self.aliasEstimatorVar = StringVar()
+        self.aliasEstimatorVar.set(ChipIdentify.alias_estimator)
+        self.menuBarAliasEstimator = Menu(self.menuBarView)
+        for estimator in sorted(ChipIdentify.alias_estimators.keys()):
+            self.menuBarAliasEstimator.add_radiobutton(label=estimator.capitalize(), variable=self.aliasEstimatorVar, value=estimator)
+        self.menuBarView.add_cascade(label='Alias Estimator', menu=self.menuBarAliasEstimator)
+        # measurements between refits of the gamma model on the front panel
+        self.aliasRefitVar = IntVar()
+        self.aliasRefitVar.set(ChipIdentify.alias_refit_interval)
+        self.menuBarAliasRefit = Menu(self.menuBarView)
+        for interval in sorted(set([1, 16, 64, 256, ChipIdentify.alias_refit_interval])):
+            self.menuBarAliasRefit.add_radiobutton(label='Every %d' % interval, variable=self.aliasRefitVar, value=interval)
+        self.menuBarView.add_cascade(label='Alias Refit', menu=self.menuBarAliasRefit)
 
         # Analyze Menu
         self.menuBarAnalyze = Menu(self.menuBar)
@@ -422,13 +449,18 @@ class Application(Frame):
         "Rebuild the PhotoImage from the PUF signature"
 
         sigVis = PhotoImage(width=self.squareSize, height=self.squareSize)
-
-        row = 0; col = 0
-        for i in range(0, self.nb):
-            sigVis.put(self.colorMapFun(i), (row, col))
-            col +=1
-            if col == self.squareSize:
-                row += 1; col = 0
+        if self.colorMapFun == self.mapBitImmDiff:
+            # unpacked once rather than for each bit
+            self.lastUnstableBits = self.chipIdentifier.get_unstable_bits(self.lastRead)
+
+        # The bits fill columns of squareSize pixels. The whole columns are
+        # put in one call, as rows of pixels.
+        colors = self.colorMapFun()
+        numCols = self.nb // self.squareSize
+        columns = colors[:numCols*self.squareSize].reshape(numCols, self.squareSize)
+        sigVis.put(' '.join('{%s}' % ' '.join(row) for row in columns.T), (0, 0))
+        for i in range(numCols*self.squareSize, self.nb):
+            sigVis.put(colors[i], (i // self.squareSize, i % self.squareSize))
 
         sigVis = sigVis.zoom(self.zoomFactor,self.zoomFactor)
 
@@ -436,11 +468,8 @@ class Application(Frame):
 
     def updateBitAvgs(self):
         """Remember the current signature so that average bit values can be calculated"""
-        for i in range(self.nb):
-            self.bitAvgs[i].append(bitstring.BitArray(bool=self.bits[i]))
-            if len(self.bitAvgs[i]) > self.maxAvgDepth:
-                # truncate to last 'n' bits
-                self.bitAvgs[i] = self.bitAvgs[i][-self.maxAvgDepth:]
+        self.bitHistory[self.numAvgs % self.maxAvgDepth] = unpack_bits(self.bits)
+        self.numAvgs += 1
 
     def setSigVis (self):
         self.sigVis = self.make_pi()
@@ -457,7 +486,7 @@ class Application(Frame):
         print self.statusStr
 
     def updateWidgets(self):
-        scores = sorted(self.chipIdentifier.MatchMap(self.bits).items(), key=lambda item: item[1])[0:self.numMatchScores]
+        scores = self.chipIdentifier.top_k(self.bits, self.numMatchScores)
         self.updateStatus()
 
         # Show matches on GUI
@@ -493,14 +522,15 @@ class Application(Frame):
             self.unstableBitVar.set('')
             self.noiseDistVar.set('')
 
-        if (self.lastRead in self.chipIdentifier.interChipDistMap):
+        if self.chipIdentifier.has_inter_chip_dists(self.lastRead):
             self.interChipDistVar.set(fmtFractionPercent(self.chipIdentifier.get_inter_dist_avg(self.lastRead), self.nb))
         else:
             self.interChipDistVar.set('')
 
 
         if self.probAliasEnVar.get() and self.chipIdentifier.get_meas_count(self.lastRead) > 2 and len(self.chipIdentifier) > 2:
-            self.probAliasingVar.set( "%.1e" % (self.chipIdentifier.prob_alias()[1]) )
+            self.chipIdentifier.alias_refit_interval = self.aliasRefitVar.get()
+            self.probAliasingVar.set( "%.1e" % (self.chipIdentifier.prob_alias(estimator=self.aliasEstimatorVar.get())[1]) )
         else:
             self.probAliasingVar.set( "N/A" )
 
@@ -539,10 +569,10 @@ class Application(Frame):
         print >> reportFile, fmtHeadingString("Current Measurement")
         # Could draw an ASCII representation here
         print >> reportFile, fmtNameAndSig(self.lastRead, self.bits)
-        print >> reportFile, fmtUnstableBitMap(self.chipIdentifier.unstableBits[self.lastRead])
+        print >> reportFile, fmtUnstableBitMap(self.chipIdentifier.get_unstable_bits(self.lastRead))
 
         print >> reportFile, fmtHeadingString("Scoreboard")
-        scores = sorted(self.chipIdentifier.MatchMap(self.bits).items(), key=lambda item: item[1])[0:self.numMatchScores]
+        scores = self.chipIdentifier.top_k(self.bits, self.numMatchScores)
         for i in range(len(scores)):
             print >> reportFile, scores[i][0], "\t", '%0.2f %%' % (100-scores[i][1]*100)
 
@@ -554,11 +584,11 @@ class Application(Frame):
             print >> reportFile, "Unstable Bits: " + fmtFractionPercent(self.chipIdentifier.get_num_unstable_bits(self.lastRead), self.nb)
             print >> reportFile, "Average Noise Distance: " + fmtFractionPercent(self.chipIdentifier.get_noise_dist_avg(self.lastRead), self.nb)
 
-        if (self.lastRead in self.chipIdentifier.interChipDistMap):
+        if self.chipIdentifier.has_inter_chip_dists(self.lastRead):
             print >> reportFile, "Average Inter-Chip Distance: " + fmtFractionPercent(self.chipIdentifier.get_inter_dist_avg(self.lastRead), self.nb)
 
         if self.chipIdentifier.get_meas_count(self.lastRead) > 2 and len(self.chipIdentifier) > 2:
-            print >> reportFile, "Probability of Aliasing: " + ( "%.3e" % (self.chipIdentifier.prob_alias()[1]) )
+            print >> reportFile, "Probability of Aliasing: " + ( "%.3e" % (self.chipIdentifier.prob_alias(estimator=self.aliasEstimatorVar.get())[1]) )
 
         print >> reportFile, "Measurement Count: " + ("Meas. #: %d" % (self.chipIdentifier.get_meas_count(self.lastRead)))
 
@@ -568,9 +598,9 @@ class Application(Frame):
             print >> reportFile, "%20s %.10e" % (name, fun_metric), fun_pass
 
         print >> reportFile, fmtHeadingString("Other Signatures")
-        for name, signature in self.chipIdentifier.signatureMap.items():
+        for name in self.chipIdentifier.chipNames:
             if (name != self.lastRead):
-                print >> reportFile, fmtNameAndSig(name, signature)+"\n"
+                print >> reportFile, fmtNameAndSig(name, self.chipIdentifier.get_sig(name))+"\n"
 
     def updateChipPicker(self):
         """This updates the optionmenu for picking a virtual chip from the sample of virtual chips. Applies only to the simulator. """
@@ -599,14 +629,16 @@ class Application(Frame):
         if ('corrector' in self.__dict__):
             del self.corrector
 
-        sigFileName = os.path.join(self.outputPath, self.sourceSelected.get(), 'signatures.xml')
+        sigFileName = os.path.join(self.outputPath, self.sourceSelected.get(), 'signatures.sigdb')
+        # databases from older versions, and the simulator's, are XML
+        xmlFileName = os.path.splitext(sigFileName)[0] + '.xml'
 
         if (self.sourceSelected.get() == 'Simulator'):
             self.bitSource = Simulator()
             self.bitSource.setup()
-            if (not os.path.isfile(sigFileName)):
+            if (not os.path.isfile(sigFileName) and not os.path.isfile(xmlFileName)):
                 print "Generating signature DB for simulator virtual chips...",
-                self.bitSource.makeSigFile(sigFileName)
+                self.bitSource.makeSigFile(xmlFileName)
                 print "OK"
         elif (self.sourceSelected.get() == 'File'):
             filename = tkFileDialog.askopenfilename(
@@ -617,7 +649,8 @@ class Application(Frame):
                 self.bitSource = SigFile(filename, self.nb)
                 sigFileName = self.loadSigFile()
                 if not sigFileName:
-                    sigFileName = os.path.join(os.path.split(filename)[0], 'signatures.xml')
+                    sigFileName = os.path.join(os.path.split(filename)[0], 'signatures.sigdb')
+                    xmlFileName = os.path.splitext(sigFileName)[0] + '.xml'
             else:
                 error = True
         elif (self.sourceSelected.get() in self.quartusSources.keys()):
@@ -630,13 +663,27 @@ class Application(Frame):
 
         if (not error):
             self.lastRead = ""
-            self.chipIdentifier = ChipIdentify(sigFileName)
+            # loadSigFile may have opened the database already
+            if 'chipIdentifier' not in self.__dict__ or self.chipIdentifier.fileName != sigFileName:
+                if 'chipIdentifier' in self.__dict__:
+                    self.chipIdentifier.close()
+                # migrate an XML database only the first time, not after the 
+                # binary one has been cleared
+                migrate = not (os.path.isfile(sigFileName) or os.path.isfile(sigFileName + '.journal'))
+                self.chipIdentifier = ChipIdentify(sigFileName)
+                if migrate and os.path.isfile(xmlFileName):
+                    print "Importing signature DB from '%s'" % xmlFileName
+                    self.chipIdentifier.import_xml(xmlFileName)
+                # save changes in the background rather than between measurements
+                self.chipIdentifier.start_autosave()
             self.reset()
             self.nextButton.config(state=NORMAL)
             self.closeButton.config(state=NORMAL)
             self.menuBarSource.entryconfig('Next', state=NORMAL)
             self.menuBarSource.entryconfig('Disconnect', state=NORMAL)
             self.menuBarChipDB.entryconfig('Clear', state=NORMAL)
+            self.menuBarChipDB.entryconfig('Import XML', state=NORMAL)
+            self.menuBarChipDB.entryconfig('Export XML', state=NORMAL)
             if (self.sourceSelected.get() == 'Simulator'):
                 self.menuBarSource.entryconfig('Simulator', state=NORMAL)
                 self.updateMenuBarSimulate()
@@ -673,13 +720,12 @@ class Application(Frame):
 
         # Determine chip's name
         if len(self.chipIdentifier)>0:
-            chip_name, match_dist = self.chipIdentifier.Identify(new_bits)
+            chip_name, match_dist = self.chipIdentifier.Identify(new_bits, self.noiseThreshold)
             print "Best match for signature: %s with %6f Hamming distance" % (chip_name, match_dist)
         if len(self.chipIdentifier)==0 or match_dist > self.noiseThreshold:
             # Don't know this chip
             chip_name = tkSimpleDialog.askstring('Enter Chip Name', 'The noise threshold (%02d %%) has been exceeded or this is a new chip.\nPlease enter its name:' % (100*self.noiseThreshold), initialvalue=chip_name if len(self.chipIdentifier)>0 else '')
             self.chipIdentifier.add(chip_name, new_bits)
-            self.chipIdentifier.save() # don't really need to do this until we close
         self.chipIdentifier.process_sig(chip_name, new_bits) # compute some greedy statistics
 
         # Don't write the bits in case of file read-back
@@ -724,7 +770,7 @@ class Application(Frame):
         if self.chipIdentifier.unstable_bits_valid(self.lastRead):
             print "Unstable bits: %d / %d = %.3f %%" % (self.chipIdentifier.get_num_unstable_bits(self.lastRead), self.nb, (float(self.chipIdentifier.get_num_unstable_bits(self.lastRead))/self.nb)*100)
             print "Unstable bit map:"
-            print repr(self.chipIdentifier.unstableBits[self.lastRead])
+            print repr(self.chipIdentifier.get_unstable_bits(self.lastRead))
 
         print "Measurement number: ", self.chipIdentifier.get_meas_count(chip_name)
 
@@ -732,7 +778,7 @@ class Application(Frame):
             self.bitFlips = hd(self.bits, new_bits)
         elif (self.chipIdentifier.get_meas_count(chip_name) > 0):
             self.measurementCounter = self.chipIdentifier.get_meas_count(chip_name)
-            self.bitFlips = hd(self.chipIdentifier.signatureMap[chip_name], new_bits)
+            self.bitFlips = hd(self.chipIdentifier.get_sig(chip_name), new_bits)
 
         self.bits = new_bits
         self.updateBitAvgs()
@@ -758,14 +804,35 @@ class Application(Frame):
 
     def loadSigFile(self, event=None):
         sigFileName = tkFileDialog.askopenfilename(
-                defaultextension=".xml",
-                filetypes=[("Signature XML File", ".xml")],
+                defaultextension=".sigdb",
+                filetypes=[("Signature DB File", ".sigdb"), ("Signature SQLite DB", ".sqlite"), ("Signature XML File", ".xml")],
                 title="Choose Signature DB File")
         if sigFileName != '':
+            if 'chipIdentifier' in self.__dict__:
+                self.chipIdentifier.close()
             self.chipIdentifier = ChipIdentify(sigFileName)
+            self.chipIdentifier.start_autosave()
 
         return sigFileName
 
+    def importSigFile(self):
+        xmlFileName = tkFileDialog.askopenfilename(
+                defaultextension=".xml",
+                filetypes=[("Signature XML File", ".xml")],
+                title="Choose Signature XML File to Import")
+        if xmlFileName:
+            self.chipIdentifier.import_xml(xmlFileName)
+            if self.measurementCounter > 0:
+                self.updateWidgets()
+
+    def exportSigFile(self):
+        xmlFileName = tkFileDialog.asksaveasfilename(
+                defaultextension=".xml",
+                filetypes=[("Signature XML File", ".xml")],
+                title="Export Signature DB as XML")
+        if xmlFileName:
+            self.chipIdentifier.export_xml(xmlFileName)
+
     def clearSigFile(self):
         if tkMessageBox.askyesno("Confirm", "Are you sure you want to clear the Signature DB\nat '%s'?" % self.chipIdentifier.fileName):
             self.chipIdentifier.clear()
@@ -815,19 +882,27 @@ class Application(Frame):
         frac_bits = self.distHistFractions.get() != 0
         plt.ion() # switch to interactive mode, else plot functions block GUI operation
 
-        noise_dists = numpy.array(self.chipIdentifier.get_all_noise_dists(), numpy.double)
-        inter_chip_dists = numpy.array(self.chipIdentifier.get_all_inter_chip_dists(), numpy.double)
+        # Distances are plotted from the histograms kept by the chip DB, as 
+        # the distinct distances weighted by their counts
+        noise_hist = self.chipIdentifier.get_noise_dist_hist()
+        noise_dists = numpy.flatnonzero(noise_hist).astype(numpy.double)
+        noise_weights = noise_hist[noise_hist > 0]
+        inter_chip_hist = self.chipIdentifier.get_inter_chip_dist_hist()
+        inter_chip_dists = numpy.flatnonzero(inter_chip_hist).astype(numpy.double)
+        inter_chip_weights = inter_chip_hist[inter_chip_hist > 0]
 
-        noise_threshold, prob_alias = self.chipIdentifier.prob_alias()
+        noise_threshold, prob_alias = self.chipIdentifier.prob_alias(estimator=self.aliasEstimatorVar.get())
         title = "Noise and Inter-Chip Hamming Distances\nProbability of Aliasing: %1.3e" % prob_alias
+        noise_mean = numpy.average(noise_dists, weights=noise_weights)
         noise_label = 'Noise $\\mu=$' + \
-                ('%0.3f' % float(sum(noise_dists)/len(noise_dists)/self.nb) if frac_bits else
-                        ('%d' % (sum(noise_dists)/len(noise_dists)) ) ) + \
-                ', $N=$%d' % len(noise_dists)
+                ('%0.3f' % float(noise_mean/self.nb) if frac_bits else
+                        ('%d' % noise_mean ) ) + \
+                ', $N=$%d' % noise_weights.sum()
+        inter_chip_mean = numpy.average(inter_chip_dists, weights=inter_chip_weights)
         inter_chip_label = 'Inter-Chip $\\mu=$' + \
-                ('%0.3f' % float(sum(inter_chip_dists)/len(inter_chip_dists)/self.nb) if frac_bits else
-                        ('%d' % (sum(inter_chip_dists)/len(inter_chip_dists)) ) ) + \
-                ', $N=$%d' % len(inter_chip_dists)
+                ('%0.3f' % float(inter_chip_mean/self.nb) if frac_bits else
+                        ('%d' % inter_chip_mean ) ) + \
+                ', $N=$%d' % inter_chip_weights.sum()
         noise_threshold_label = "Noise Threshold = " + \
                 (("%1.3f" % (float(noise_threshold)/self.nb)) if frac_bits else
                         ('%d' % math.ceil(noise_threshold)))
@@ -837,8 +912,8 @@ class Application(Frame):
 
         if self.distHistSelected.get() == 'Simple':
             plt.xlim(0, 1 if frac_bits else self.nb)
-            plt.hist(noise_dists/(self.nb if frac_bits else 1), normed=True, cumulative=False, color='r', label=noise_label)
-            plt.hist(inter_chip_dists/(self.nb if frac_bits else 1), normed=True, cumulative=False, color='b', label=inter_chip_label)
+            plt.hist(noise_dists/(self.nb if frac_bits else 1), weights=noise_weights, normed=True, cumulative=False, color='r', label=noise_label)
+            plt.hist(inter_chip_dists/(self.nb if frac_bits else 1), weights=inter_chip_weights, normed=True, cumulative=False, color='b', label=inter_chip_label)
             plt.axvline(noise_threshold/(self.nb if frac_bits else 1), color='g', label=noise_threshold_label)
             plt.title(title)
             plt.xlabel(xlabel)
@@ -847,22 +922,22 @@ class Application(Frame):
         elif self.distHistSelected.get() == 'Split':
             plt.subplot(211)
             plt.title(title)
-            plt.hist(noise_dists/(self.nb if frac_bits else 1), normed=True, cumulative=False, color='r', label=noise_label)
+            plt.hist(noise_dists/(self.nb if frac_bits else 1), weights=noise_weights, normed=True, cumulative=False, color='r', label=noise_label)
             plt.axvline(noise_threshold/(self.nb if frac_bits else 1), color='g', label=noise_threshold_label)
             plt.ylabel("Probability")
             plt.legend()
 
             plt.subplot(212)
-            plt.hist(inter_chip_dists/(self.nb if frac_bits else 1), normed=True, cumulative=False, color='b', label=inter_chip_label)
+            plt.hist(inter_chip_dists/(self.nb if frac_bits else 1), weights=inter_chip_weights, normed=True, cumulative=False, color='b', label=inter_chip_label)
             plt.xlabel(xlabel)
             plt.ylabel("Probability")
             plt.legend()
         elif self.distHistSelected.get() == 'Cumulative':
-            nd_hist, nd_bin_edges = numpy.histogram(noise_dists, density=True)
+            nd_hist, nd_bin_edges = numpy.histogram(noise_dists, weights=noise_weights, density=True)
             nd_hist_cum = nd_hist.cumsum().astype(float) / sum(nd_hist)
             plt.plot(numpy.append(nd_bin_edges, self.nb)/(self.nb if frac_bits else 1), numpy.append(nd_hist_cum, [1, 1]), drawstyle='steps', color='r', label=noise_label)
 
-            icd_hist, icd_bin_edges = numpy.histogram(inter_chip_dists, density=True)
+            icd_hist, icd_bin_edges = numpy.histogram(inter_chip_dists, weights=inter_chip_weights, density=True)
             icd_hist_cum = icd_hist.cumsum().astype(float) / sum(icd_hist)
             plt.plot(numpy.append(icd_bin_edges, self.nb)/(self.nb if frac_bits else 1), numpy.append(icd_hist_cum, [1, 1]), drawstyle='steps', color='b', label=inter_chip_label)
 
@@ -0,0 +1,223 @@
+"""
+sqlitestore.py - A chip signature database kept in SQLite, so that it
+can be opened without reading it whole and updated in place a few chips
+at a time. Other programs can read it while SPAT writes it, but only one
+SPAT instance may write to it.
+
+The tables hold one row per chip, its signature and bit flip counts,
+and one row of distance samples per pair of chips. Noise distances are
+stored as the samples of a chip paired with itself.
+"""
+
+__license__ = """
+GPL Version 3
+
+Copyright (2014) Sandia Corporation. Under the terms of Contract
+DE-AC04-94AL85000, there is a non-exclusive license for use of this
+work by or on behalf of the U.S. Government. Export of this program
+may require a license from the United States Government.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__version__ = "1.2"
+
+__author__ = "Ryan Helinski and Mitch Martin"
+
+import sqlite3, threading
+import numpy
+
+class SQLiteStore(object):
+    """Reads and writes the rows of a chip signature database. Chips are
+    identified by their row in the signature matrix. The connection may be
+    used from more than one thread, one at a time.
+
+    Each write counts itself in the write_seq meta row. A write fails if 
+    another instance has written since this one opened the database or 
+    last wrote it, since the ids of new chips, the distances and the 
+    histograms of the two would overwrite each other."""
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS chips (
+            id INTEGER PRIMARY KEY,
+            name TEXT UNIQUE NOT NULL,
+            meas_count INTEGER NOT NULL,
+            has_noise INTEGER NOT NULL,
+            has_inter_chip INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS signatures (
+            chip_id INTEGER PRIMARY KEY REFERENCES chips(id),
+            sig BLOB NOT NULL);
+        CREATE TABLE IF NOT EXISTS unstable_bits (
+            chip_id INTEGER PRIMARY KEY REFERENCES chips(id),
+            bits BLOB NOT NULL);
+        CREATE TABLE IF NOT EXISTS flip_counts (
+            chip_id INTEGER PRIMARY KEY REFERENCES chips(id),
+            counts BLOB NOT NULL);
+        CREATE TABLE IF NOT EXISTS dist_samples (
+            chip_id INTEGER NOT NULL REFERENCES chips(id),
+            other_id INTEGER NOT NULL REFERENCES chips(id),
+            dists BLOB NOT NULL,
+            PRIMARY KEY (chip_id, other_id));
+        CREATE TABLE IF NOT EXISTS histograms (
+            kind TEXT PRIMARY KEY,
+            counts BLOB NOT NULL);
+        """
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        # wait for another instance's write to finish rather than failing
+        self.connection = sqlite3.connect(fileName, timeout=60, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.connection.text_factory = str
+        # readers don't block the writer, nor the writer readers
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(self.schema)
+        self.writeSeq = self.get_meta('write_seq', 0)
+
+    def reset(self):
+        """Delete every row"""
+        for table in ['meta', 'chips', 'signatures', 'unstable_bits', 'flip_counts', 'dist_samples', 'histograms']:
+            self.connection.execute('DELETE FROM %s' % table)
+
+    def get_meta(self, key, default=None):
+        row = self.query('SELECT value FROM meta WHERE key = ?', (key,))[:1]
+        return default if not row else row[0][0]
+
+    def set_meta(self, key, value):
+        self.connection.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, value))
+
+    def query(self, sql, parameters=()):
+        """All the rows selected by a query"""
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def read_chips(self):
+        """Lists of the id, name, meas_count, has_noise and has_inter_chip
+        columns of the chips, in order of id"""
+        rows = self.query('SELECT id, name, meas_count, has_noise, has_inter_chip FROM chips ORDER BY id')
+        return [list(column) for column in zip(*rows)] if rows else [[], [], [], [], []]
+
+    def read_signatures(self, dtype):
+        """The signatures of all chips, in order of id, concatenated into one array"""
+        rows = self.query('SELECT sig FROM signatures ORDER BY chip_id')
+        return numpy.frombuffer(''.join(str(sig) for sig, in rows), dtype)
+
+    def read_unstable_bits(self, dtype):
+        """The ids of the chips with unstable bit maps but no flip counts, 
+        as written by older versions, and the maps, concatenated into one array"""
+        rows = self.query('SELECT chip_id, bits FROM unstable_bits WHERE chip_id NOT IN (SELECT chip_id FROM flip_counts) ORDER BY chip_id')
+        return [chip_id for chip_id, bits in rows], numpy.frombuffer(''.join(str(bits) for chip_id, bits in rows), dtype)
+
+    def read_flip_counts(self, dtype):
+        """The ids of the chips with bit flip counts, and the counts, 
+        concatenated into one array"""
+        rows = self.query('SELECT chip_id, counts FROM flip_counts ORDER BY chip_id')
+        return [chip_id for chip_id, counts in rows], numpy.frombuffer(''.join(str(counts) for chip_id, counts in rows), dtype)
+
+    def read_dists(self, chip_id, dtype, others=None):
+        """The distance samples of one chip paired with the chips in others,
+        or all chips but itself if others is None, as a list of other chip
+        ids and a list of arrays"""
+        if others is None:
+            rows = self.query('SELECT other_id, dists FROM dist_samples WHERE chip_id = ? AND other_id != chip_id', (chip_id,))
+        else:
+            rows = self.query('SELECT other_id, dists FROM dist_samples WHERE chip_id = ? AND other_id IN (%s)' %
+                ','.join('?' * len(others)), [chip_id] + list(others))
+        return [other for other, dists in rows], [numpy.frombuffer(dists, dtype) for other, dists in rows]
+
+    def read_hist(self, kind, dtype):
+        row = self.query('SELECT counts FROM histograms WHERE kind = ?', (kind,))[:1]
+        return None if not row else numpy.frombuffer(row[0][0], dtype)
+
+    def write_chips(self, records, hists, meta, reset=False):
+        """Write the records of some chips, in one transaction. Each record 
+        is a tuple of the arguments to write_chip, the bit flip counts 
+        or None, and the arguments to write_dists but chip_id. The rows of 
+        the chips not written are deleted first if reset is set."""
+        with self.lock:
+            with self.connection:
+                if reset:
+                    self.reset()
+                    self.set_meta('write_seq', self.writeSeq + 1)
+                elif not self.count_write():
+                    raise IOError('\'%s\' has been changed by another SPAT instance' % self.fileName)
+                for key, value in meta.items():
+                    self.set_meta(key, value)
+                for record in records:
+                    chip_id = record[0]
+                    self.write_chip(*record[:6])
+                    if record[6] is not None:
+                        self.write_flip_counts(chip_id, record[6])
+                    self.write_dists(chip_id, *record[7:])
+                for kind, counts in hists.items():
+                    self.write_hist(kind, counts)
+            self.writeSeq += 1
+
+    def count_write(self):
+        """Increment write_seq, within the transaction of a write, unless 
+        another instance has written. Returns whether it was incremented."""
+        # databases written by older versions have no write_seq
+        self.connection.execute("INSERT OR IGNORE INTO meta VALUES ('write_seq', 0)")
+        return self.connection.execute("UPDATE meta SET value = value + 1 WHERE key = 'write_seq' AND value = ?",
+            (self.writeSeq,)).rowcount == 1
+
+    def write_chip(self, chip_id, name, meas_count, has_noise, has_inter_chip, sig):
+        self.connection.execute('INSERT OR REPLACE INTO chips VALUES (?, ?, ?, ?, ?)',
+            (chip_id, name, meas_count, int(has_noise), int(has_inter_chip)))
+        self.connection.execute('INSERT OR REPLACE INTO signatures VALUES (?, ?)', (chip_id, buffer(sig.tostring())))
+
+    def write_flip_counts(self, chip_id, counts):
+        self.connection.execute('INSERT OR REPLACE INTO flip_counts VALUES (?, ?)', (chip_id, buffer(counts.tostring())))
+
+    def write_dists(self, chip_id, others, dists, counts):
+        """Replace the distance samples of one chip paired with each of
+        others with the rows of dists, of which the first counts are held"""
+        self.connection.executemany('INSERT OR REPLACE INTO dist_samples VALUES (?, ?, ?)',
+            ((chip_id, other, buffer(row[:count].tostring())) for other, row, count in zip(others, dists, counts)))
+
+    def write_hist(self, kind, counts):
+        self.connection.execute('INSERT OR REPLACE INTO histograms VALUES (?, ?)', (kind, buffer(counts.tostring())))
+
+    def close(self):
+        self.connection.close()
+
+class PagedList(list):
+    """A list, some of whose items are read from a store the first time 
+    they are looked up. The other items start out as None."""
+
+    def __init__(self, length, stored, loader):
+        list.__init__(self, [None] * length)
+        self.stored = set(stored)
+        self.loader = loader
+
+    def __getitem__(self, index):
+        if index in self.stored:
+            self[index] = self.loader(index)
+        return list.__getitem__(self, index)
+
+    def __setitem__(self, index, value):
+        self.stored.discard(index)
+        list.__setitem__(self, index, value)
+
+    def __iter__(self):
+        self.page_in()
+        return list.__iter__(self)
+
+    def page_in(self):
+        """Read all of the stored items"""
+        for index in list(self.stored):
+            self[index]